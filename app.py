@@ -5,6 +5,7 @@ from flask import Flask
 from callbacks import register_callbacks
 from layouts import apply_layout
 
+from terracotta_client import client_stats
 from config import DASH_DEFAULT_PORT
 
 server = Flask(__name__)
@@ -13,5 +14,12 @@ app = dash.Dash(__name__, server=server)
 apply_layout(app)  # create client UI
 register_callbacks(app)  # enable ui interactions (server->client callbacks)
 
+
+@server.route("/terracotta-client/stats")
+def terracotta_client_stats():
+    # latency histograms of the calls made to the tile servers
+    return client_stats()
+
+
 if __name__ == '__main__':
     app.run_server(port=DASH_DEFAULT_PORT, debug=True)
@@ -0,0 +1,39 @@
+// Callbacks that only reshape UI state. They run in the browser
+// so they never cost a request to the Dash server
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ui: {
+        tile_opacity: function (opacity) {
+            return opacity;
+        },
+
+        geolayer_url: function (value) {
+            return "https://{s}.basemaps.cartocdn.com/rastertiles/" + value + "/{z}/{x}/{y}{r}.png";
+        },
+
+        add_button_disabled: function (selectedGranule) {
+            return selectedGranule === null || selectedGranule === undefined;
+        }
+    },
+
+    map: {
+        // the server picks the datasets and default stretch, changing
+        // the stretch or colormap afterwards only rewrites the tile url
+        style_tiles: function (baseUrl, stretchRange, colormap) {
+            if (!baseUrl || !stretchRange || !colormap) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            var url = baseUrl +
+                "&colormap=" + encodeURIComponent(colormap.toLowerCase()) +
+                "&stretch_range=" + encodeURIComponent(JSON.stringify(stretchRange));
+
+            var marks = {};
+            stretchRange.forEach(function (value) {
+                marks[Math.floor(value)] = value.toFixed(1);
+            });
+
+            // the colorbar shows the stretch, the slider the full range
+            return [url, colormap, stretchRange[0], stretchRange[1], "radiance", marks];
+        }
+    }
+});
@@ -0,0 +1,173 @@
+"""
+End to end ingestion and serving benchmark on synthetic HARP2
+L1C granules. Runs the production pipeline: convert_granule
+(resampling, COG writing, quantization and statistics), the
+ingest server's insert, then renders the /combine tiles the map
+requests through the tile server app, with its tile cache and
+scaling. Writes throughput, latency percentiles and peak RSS
+to JSON.
+
+Run from the repository root:
+    python -m benchmarks.bench_ingest --granules 3 --output bench_ingest.json
+
+--max-memory-bytes selects the streaming conversion, which only
+needs netCDF4. The in-memory conversion reads granules with the
+NASA PACE L1 reader.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+import terracotta_server
+from benchmarks.synthetic_granule import DEFAULT_SHAPE, write_synthetic_granules
+from geospatial_data.ingest import convert_granule
+from terracotta_server import CHANNEL_INDEXES, CHANNEL_WORKERS, RGB_CHANNELS, PACEHARP2TCServer
+from tile_server import create_server_app
+from tile_warmer import granule_tile_urls
+
+TILE_ZOOMS = [9, 10, 11]
+PERCENTILES = [50, 90, 99]
+
+
+class StageTimer:
+    """
+    Collects the duration and processed amount of every run
+    of each benchmark stage
+    """
+
+    def __init__(self):
+        self._runs = {}
+
+    def time(self, stage, function, *args, amount=1, unit="calls", **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.record(stage, time.perf_counter() - start, amount, unit)
+
+        return result
+
+    def record(self, stage, seconds, amount=1, unit="calls"):
+        self._runs.setdefault(stage, {"unit": unit, "durations": [], "amount": 0})
+        self._runs[stage]["durations"].append(seconds)
+        self._runs[stage]["amount"] += amount
+
+    def summary(self):
+        summary = {}
+
+        for stage, runs in self._runs.items():
+            durations = np.array(runs["durations"])
+            total = float(durations.sum())
+
+            summary[stage] = {
+                "runs": len(durations),
+                "total_s": total,
+                "mean_s": float(durations.mean()),
+                **{f"p{p}_s": float(np.percentile(durations, p)) for p in PERCENTILES},
+                "max_s": float(durations.max()),
+                "throughput": runs["amount"] / total if total > 0 else None,
+                "throughput_unit": f"{runs['unit']}/s"
+            }
+
+        return summary
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_granule(timer, nc_path, server, workers):
+    l1_meta, outputs, statistics, stages = timer.time(
+        "convert_granule", convert_granule, nc_path, server._driver_path, workers=workers,
+        **server._conversion_options())
+
+    # seconds of every conversion stage, as the metrics spans report them
+    for stage, seconds in stages.items():
+        timer.record(f"convert:{stage}", seconds)
+
+    timer.time("insert_granule", server._insert_granule, l1_meta, outputs, nc_path, statistics)
+
+    return l1_meta
+
+
+def benchmark_serving(timer, granules, client):
+    for l1_meta in granules:
+        metadatas = {}
+
+        for channel in CHANNEL_INDEXES:
+            keys = "/".join(list(l1_meta[key] for key in ["campaign", "instrument", "date", "level"]) + [channel])
+            response = timer.time("metadata", client.get, f"/metadata/{keys}")
+            assert response.status_code == 200, response.data
+            metadatas[channel] = response.json
+
+        convex_hull = metadatas[RGB_CHANNELS[0]]["convex_hull"]
+        urls = granule_tile_urls(l1_meta, CHANNEL_INDEXES.keys(), RGB_CHANNELS, convex_hull, metadatas, TILE_ZOOMS)
+
+        # rendered first, then served from the tile cache
+        for stage in ["combine_tile", "combine_tile_cached"]:
+            for url in urls:
+                response = timer.time(stage, client.get, url, unit="tiles")
+                assert response.status_code == 200, response.data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HARP2 ingestion and tile benchmark")
+    parser.add_argument("--granules", type=int, default=3, help="number of synthetic granules")
+    parser.add_argument("--shape", type=int, nargs=3, default=DEFAULT_SHAPE,
+                        metavar=("ROWS", "COLS", "VIEWS"), help="granule dimensions")
+    parser.add_argument("--output", default="bench_ingest.json", help="JSON results file")
+    parser.add_argument("--max-memory-bytes", type=int, default=terracotta_server.CONVERSION_MEMORY_BYTES,
+                        help="streaming conversion memory ceiling, in-memory conversion when unset")
+    parser.add_argument("--storage", default=terracotta_server.COG_STORAGE, help="stored pixel type")
+    parser.add_argument("--workers", type=int, default=CHANNEL_WORKERS, help="channel threads per granule")
+    args = parser.parse_args(argv)
+
+    # the ingest server reads its conversion options from these
+    terracotta_server.CONVERSION_MEMORY_BYTES = args.max_memory_bytes
+    terracotta_server.COG_STORAGE = args.storage
+    timer = StageTimer()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        start = time.perf_counter()
+        paths = write_synthetic_granules(work_dir, args.granules, tuple(args.shape))
+        generate_seconds = time.perf_counter() - start
+
+        db_path = os.path.join(work_dir, "database")
+        server = PACEHARP2TCServer(db_path, nuke=True, warm_tiles=False)
+
+        start = time.perf_counter()
+        granules = [benchmark_granule(timer, path, server, args.workers) for path in paths]
+        ingest_seconds = time.perf_counter() - start
+
+        benchmark_serving(timer, granules, create_server_app(db_path).test_client())
+
+    results = {
+        "granules": args.granules,
+        "shape": list(args.shape),
+        "max_memory_bytes": args.max_memory_bytes,
+        "storage": args.storage,
+        "generate_s": generate_seconds,
+        "ingest_s": ingest_seconds,
+        "ingest_granules_per_s": args.granules / ingest_seconds,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "stages": timer.summary()
+    }
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+
+    print(f"{'stage':<20}{'runs':>6}{'p50 (ms)':>12}{'p99 (ms)':>12}{'throughput':>24}")
+
+    for stage, stats in results["stages"].items():
+        throughput = f"{stats['throughput']:.1f} {stats['throughput_unit']}"
+        print(f"{stage:<20}{stats['runs']:>6}{stats['p50_s'] * 1000:>12.1f}{stats['p99_s'] * 1000:>12.1f}{throughput:>24}")
+
+    print(f"\npeak RSS {results['peak_rss_bytes'] / 2**20:.0f} MiB, results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
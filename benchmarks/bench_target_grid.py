@@ -0,0 +1,110 @@
+"""
+Compares target grid generation through rasterio's per-pixel
+transform.xy against the broadcast affine computation, on its
+own and as part of a full granule conversion, reporting wall
+time and peak traced memory.
+
+Run from the repository root on a real granule:
+    python -m benchmarks.bench_target_grid path/to/granule.nc
+or without arguments on a synthetic swath of flight line size.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from rasterio.transform import xy
+
+from geospatial_data.l1_to_tiff import (compute_grid_transform, compute_neighbour_info,
+                                        compute_target_grid, l1_to_tiffs, read_l1_data)
+
+CHANNEL_INDEXES = {"red": 40, "green": 4, "blue": 84, "infrared": 74}
+RESAMPLE_RADIUS = 300
+# rows, cols and views of the synthetic swath
+SYNTHETIC_SHAPE = (2400, 520, 90)
+
+
+def legacy_compute_target_grid(l1_data):
+    transform, (height, width) = compute_grid_transform(l1_data["latitude"], l1_data["longitude"])
+
+    rows, cols = np.meshgrid(
+        np.arange(height), np.arange(width), indexing="ij")
+    xs, ys = xy(transform, rows.flatten(), cols.flatten())
+
+    transformed_longitude = np.array(xs).reshape((height, width))
+    transformed_latitude = np.array(ys).reshape((height, width))
+
+    return transform, transformed_latitude, transformed_longitude
+
+
+def prepare_grid_with(target_grid):
+    def prepare(l1_data):
+        transform, target_latitude, target_longitude = target_grid(l1_data)
+        neighbour_info = compute_neighbour_info(l1_data["latitude"], l1_data["longitude"],
+                                                target_latitude, target_longitude, RESAMPLE_RADIUS)
+        return transform, neighbour_info
+
+    return prepare
+
+
+def convert_with(target_grid):
+    prepare = prepare_grid_with(target_grid)
+
+    def convert(l1_data):
+        with tempfile.TemporaryDirectory() as output_dir:
+            export_files = {os.path.join(output_dir, f"{channel}.tif"): index
+                            for channel, index in CHANNEL_INDEXES.items()}
+            l1_to_tiffs(l1_data, export_files, RESAMPLE_RADIUS, prepare(l1_data), cog=True)
+
+    return convert
+
+
+def synthetic_granule(seed=0):
+    # slightly rotated swath with ~100 m pixels, views share
+    # one slice so the granule itself stays small in memory
+    rows, cols, views = SYNTHETIC_SHAPE
+    row, col = np.meshgrid(np.arange(rows), np.arange(cols), indexing="ij")
+    intensity = np.random.default_rng(seed).random((rows, cols, 1, 1), dtype="float32")
+
+    return {
+        "latitude": (34 + row * 9e-4 + col * 2e-4).astype("float32"),
+        "longitude": (-120 + col * 1.1e-3 - row * 2e-4).astype("float32"),
+        "i": np.broadcast_to(intensity, (rows, cols, views, 1))
+    }
+
+
+def measure(function, l1_data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(l1_data)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak / 2**20
+
+
+def main(argv):
+    l1_data = read_l1_data(argv[0], "l1c") if len(argv) > 0 else synthetic_granule()
+    shape = l1_data["latitude"].shape
+
+    _, legacy_latitude, legacy_longitude = legacy_compute_target_grid(l1_data)
+    _, latitude, longitude = compute_target_grid(l1_data)
+    error = max(np.abs(legacy_latitude - latitude).max(), np.abs(legacy_longitude - longitude).max())
+    print(f"swath {shape[0]}x{shape[1]}, max coordinate difference {error:.2e} degrees\n")
+
+    print(f"{'benchmark':<20}{'legacy (s)':>12}{'affine (s)':>12}{'legacy (MiB)':>14}{'affine (MiB)':>14}")
+
+    for name, legacy, affine in [
+        ("target grid", legacy_compute_target_grid, compute_target_grid),
+        ("conversion", convert_with(legacy_compute_target_grid), convert_with(compute_target_grid))
+    ]:
+        legacy_time, legacy_peak = measure(legacy, l1_data)
+        affine_time, affine_peak = measure(affine, l1_data)
+        print(f"{name:<20}{legacy_time:>12.3f}{affine_time:>12.3f}{legacy_peak:>14.1f}{affine_peak:>14.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
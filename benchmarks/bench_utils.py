@@ -0,0 +1,96 @@
+"""
+Compares the NumPy backed date and geometry helpers in utils
+against the original pure Python loops on campaign sized inputs.
+
+Run from the repository root:
+    python -m benchmarks.bench_utils
+"""
+from datetime import datetime, timedelta
+import random
+import timeit
+
+from utils import get_date_range, get_average_of_coordinates
+
+GRANULE_COUNTS = [1_000, 10_000, 50_000]
+HULL_SIZES = [1_000, 100_000, 1_000_000]
+CAMPAIGN_DAYS = 120
+
+
+def legacy_get_date_range(available):
+    min = available[0]
+    max = available[0]
+    unavailable = []
+
+    for day in available:
+        if day < min:
+            min = day
+        if day > max:
+            max = day
+
+    current = min
+
+    while current < max:
+        available_dates = [dt.date() for dt in available]
+
+        if current.date() not in available_dates:
+            unavailable.append(current)
+
+        current += timedelta(days=1)
+
+    return min, max, unavailable
+
+
+def legacy_get_average_of_coordinates(points):
+    x_sum = 0
+    y_sum = 0
+
+    for point in points:
+        x_sum += point[0]
+        y_sum += point[1]
+
+    total_points = len(points)
+
+    return [x_sum / total_points, y_sum / total_points]
+
+
+def campaign_granules(count, seed=0):
+    # granules spread over a campaign with a few idle days
+    rng = random.Random(seed)
+    start = datetime(2024, 9, 1)
+    idle = set(rng.sample(range(CAMPAIGN_DAYS), CAMPAIGN_DAYS // 5))
+    days = [day for day in range(CAMPAIGN_DAYS) if day not in idle]
+
+    return [start + timedelta(days=rng.choice(days), seconds=rng.randrange(86400))
+            for _ in range(count)]
+
+
+def convex_hull(size, seed=0):
+    rng = random.Random(seed)
+    return [[rng.uniform(-125, -115), rng.uniform(30, 40)] for _ in range(size)]
+
+
+def best_of(function, *args, repeat=3):
+    return min(timeit.repeat(lambda: function(*args), number=1, repeat=repeat))
+
+
+def main():
+    print(f"{'benchmark':<32}{'size':>10}{'legacy (s)':>14}{'numpy (s)':>14}{'speedup':>10}")
+
+    for count in GRANULE_COUNTS:
+        granules = campaign_granules(count)
+        assert legacy_get_date_range(granules)[2] == get_date_range(granules)[2]
+
+        legacy = best_of(legacy_get_date_range, granules, repeat=1)
+        vectorized = best_of(get_date_range, granules)
+        print(f"{'get_date_range':<32}{count:>10}{legacy:>14.4f}{vectorized:>14.4f}{legacy / vectorized:>9.1f}x")
+
+    for size in HULL_SIZES:
+        points = convex_hull(size)
+
+        legacy = best_of(legacy_get_average_of_coordinates, points)
+        vectorized = best_of(get_average_of_coordinates, points)
+        print(f"{'get_average_of_coordinates':<32}{size:>10}{legacy:>14.4f}{vectorized:>14.4f}{legacy / vectorized:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
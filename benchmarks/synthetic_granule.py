@@ -0,0 +1,141 @@
+"""
+Writes synthetic HARP2 L1C granules: netCDF files with the
+groups, variables and array layout of the real product, a
+flight line swath and smooth, view dependent radiances.
+"""
+from datetime import datetime, timedelta
+import math
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+# rows, cols and views of an airborne flight line segment
+DEFAULT_SHAPE = (600, 300, 90)
+# meters between swath pixels
+PIXEL_SPACING = 110
+EARTH_RADIUS = 6370997.0
+QUANTITIES = ["i", "q", "u", "dolp"]
+# HARP2 wavelengths in nm, views are spread over them
+WAVELENGTHS = [441, 549, 669, 873]
+FILL_VALUE = -999.0
+
+
+def granule_filename(start, campaign="PACEPAX", instrument="AH2MAP", level="L1C"):
+    """
+    Filename in the naming convention extract_granule_metadata parses
+    """
+    return f"{campaign}-{instrument}-{level}_ER2_{start:%Y%m%dT%H%M%S}_RA.nc"
+
+
+def swath_geolocation(rows, cols, start_lat=34.0, start_lon=-120.0, heading=20.0, turn=0.01):
+    """
+    Latitude and longitude of a slowly turning flight line. Rows
+    run along track, columns across it, and the outer columns
+    of every row miss geolocation like the real swath edges
+    """
+    across = (np.arange(cols) - cols / 2) * PIXEL_SPACING
+    bearing = np.radians(heading + turn * np.arange(rows))
+
+    # dead reckoning of the aircraft track, then offset
+    # every pixel perpendicular to it
+    north = np.concatenate([[0], np.cumsum(np.cos(bearing[1:]) * PIXEL_SPACING)])
+    east = np.concatenate([[0], np.cumsum(np.sin(bearing[1:]) * PIXEL_SPACING)])
+    north = north[:, np.newaxis] - np.sin(bearing)[:, np.newaxis] * across
+    east = east[:, np.newaxis] + np.cos(bearing)[:, np.newaxis] * across
+
+    latitude = start_lat + np.degrees(north / EARTH_RADIUS)
+    longitude = start_lon + np.degrees(east / (EARTH_RADIUS * math.cos(math.radians(start_lat))))
+
+    # the first and last rows stay complete, the target
+    # grid is anchored on the swath corners
+    edge = np.abs(across) > 0.47 * cols * PIXEL_SPACING
+    edge = edge & (np.random.default_rng(rows).random((rows, cols)) < 0.5)
+    edge[[0, -1]] = False
+    latitude[edge] = np.nan
+    longitude[edge] = np.nan
+
+    return latitude.astype("float32"), longitude.astype("float32")
+
+
+def observations(rows, cols, views, seed=0):
+    """
+    Smooth scene with a view angle dependent brightness, so
+    every view slice differs and compresses like real data
+    """
+    rng = np.random.default_rng(seed)
+    row, col = np.ogrid[:rows, :cols]
+    scene = (60 + 25 * np.sin(row / 37 + rng.random() * 6) * np.cos(col / 23)).astype("float32")
+    view_scale = (0.6 + 0.4 * np.cos(np.linspace(-1, 1, views))).astype("float32")
+
+    intensity = scene[:, :, np.newaxis] * view_scale
+    dolp = (0.1 + 0.2 * np.abs(np.sin(np.linspace(0, 3, views)))).astype("float32")
+
+    return {
+        "i": intensity,
+        "q": intensity * 0.1,
+        "u": intensity * -0.05,
+        "dolp": np.broadcast_to(dolp, intensity.shape)
+    }
+
+
+def write_synthetic_granule(path, shape=DEFAULT_SHAPE, seed=0, **geolocation):
+    """
+    Writes one granule of (rows, cols, views) shape, geolocation
+    takes the keyword arguments of swath_geolocation
+    """
+    rows, cols, views = shape
+    latitude, longitude = swath_geolocation(rows, cols, **geolocation)
+
+    with Dataset(path, "w") as dataset:
+        dataset.title = "Synthetic HARP2 L1C granule"
+        dataset.createDimension("bins_along_track", rows)
+        dataset.createDimension("bins_across_track", cols)
+        dataset.createDimension("number_of_views", views)
+        dataset.createDimension("intensity_bands_per_view", 1)
+        dataset.createDimension("polarization_bands_per_view", 1)
+
+        sensor = dataset.createGroup("sensor_views_bands")
+        geolocation_group = dataset.createGroup("geolocation_data")
+        observation = dataset.createGroup("observation_data")
+
+        view_dims = ("number_of_views", "intensity_bands_per_view")
+        sensor.createVariable("view_angles", "f4", ("number_of_views",))[:] = np.linspace(-57, 57, views)
+        wavelength = np.repeat(WAVELENGTHS, math.ceil(views / len(WAVELENGTHS)))[:views, np.newaxis]
+        sensor.createVariable("intensity_wavelength", "f4", view_dims)[:] = wavelength
+        sensor.createVariable("polarization_wavelength", "f4",
+                              ("number_of_views", "polarization_bands_per_view"))[:] = wavelength
+
+        swath_dims = ("bins_along_track", "bins_across_track")
+
+        for name, values in [("latitude", latitude), ("longitude", longitude)]:
+            variable = geolocation_group.createVariable(name, "f4", swath_dims, fill_value=FILL_VALUE)
+            variable[:] = np.ma.masked_invalid(values)
+
+        data = observations(rows, cols, views, seed)
+
+        for quantity in QUANTITIES:
+            bands_dim = "polarization_bands_per_view" if quantity == "dolp" else "intensity_bands_per_view"
+            variable = observation.createVariable(
+                quantity, "f4", swath_dims + ("number_of_views", bands_dim), fill_value=FILL_VALUE,
+                zlib=True, complevel=1, chunksizes=(min(rows, 128), cols, 1, 1))
+
+            for view in range(views):
+                variable[:, :, view, 0] = data[quantity][:, :, view]
+
+    return path
+
+
+def write_synthetic_granules(output_dir, count, shape=DEFAULT_SHAPE, start=datetime(2024, 9, 10, 17, 50, 7)):
+    """
+    Writes count granules of consecutive flight line segments.
+    Returns their paths
+    """
+    paths = []
+
+    for index in range(count):
+        path = os.path.join(output_dir, granule_filename(start + timedelta(minutes=10 * index)))
+        write_synthetic_granule(path, shape, seed=index, start_lat=34.0 + 0.3 * index)
+        paths.append(path)
+
+    return paths
@@ -1,50 +1,71 @@
-import requests
-from math import floor
-
-from dash.dependencies import Output, Input, State
+from dash import no_update
+from dash.dependencies import ClientsideFunction, Output, Input, State
 from dash.exceptions import PreventUpdate
 
-from utils import get_average_of_coordinates, combine_url
+import numpy as np
+
+from utils import get_average_of_coordinates, combine_url, percentile_stretch
 from terracotta_toolbelt import singleband_url
-from config import TC_DEFAULT_URL
+from config import TC_DEFAULT_URL, STRETCH_PERCENTILES, MAP_SESSIONS
+from .metadata_cache import get_granules_metadata
+from .request_sequence import RequestSequencer
 
 RGB_KEYS = ["red", "green", "blue"]
 
+# slider drags and quick input changes start several updates
+# per session, only the latest one is applied
+_map_updates = RequestSequencer(MAP_SESSIONS)
+
 def register_map_callbacks(app):
-    @app.callback(
+    # restyling the tiles needs no data, the browser rebuilds
+    # the url whenever the stretch or colormap changes
+    app.clientside_callback(
+        ClientsideFunction(namespace="map", function_name="style_tiles"),
         [
             Output("tc", "url"),
             Output("cbar", "colorscale"),
             Output("cbar", "min"),
             Output("cbar", "max"),
             Output("cbar", "unit"),
+            Output("srng", "marks")
+        ],
+        [
+            Input("tc-base-url", "data"),
+            Input("srng", "value"),
+            Input("dd_cmap", "value")
+        ]
+    )
+
+    @app.callback(
+        [
+            Output("tc-base-url", "data"),
             Output("map", "viewport"),
             Output("srng", "disabled"),
             Output("srng", "min"),
             Output("srng", "max"),
             Output("srng", "value"),
-            Output("srng", "marks"),
             Output("dd_cmap", "disabled")
         ],
         [
             Input("date-picker", "date"),
             Input("granules", "value"),
-            Input("dd_cmap", "value"),
-            Input("srng", "value"),
             State("srng", "min"),
             State("srng", "max"),
             Input("dd_param", "value"),
             Input("campaign_selector", "value"),
             Input("instrument_selector", "value"),
             Input("level_selector", "value"),
-            State("selected-granules-list", "children")
+            State("selected-granules-list", "children"),
+            State("session-id", "data")
         ]
     )
-    def configure_map_properties(date, time, cmap, srng, curr_min, curr_max,
-        channel, campaign, instrument, level, selected_granules):
-        if any(arg == None for arg in [date, cmap, time, campaign, instrument, level]):
+    def configure_map_properties(date, time, curr_min, curr_max,
+        channel, campaign, instrument, level, selected_granules, session_id):
+        if any(arg == None for arg in [date, time, campaign, instrument, level]):
             raise PreventUpdate
 
+        ticket = _map_updates.begin(session_id)
+
         query_granules = []
 
         for view in selected_granules:
@@ -57,26 +78,30 @@ def register_map_callbacks(app):
         # try:
             query_channel = channel
             is_combined_rgb = channel == "combined (rgb)"
+            query_channels = [channel]
 
             if is_combined_rgb:
-                # since we are combing values from multiple channels
-                # it does not make sense to respect stretch range since
-                # each channel has its own range. we can default to red
+                # one stretch is applied to all three channels,
+                # so it is taken over their combined histograms
                 query_channel = "red"
+                query_channels = RGB_KEYS
 
             formatted_date = f"{date}_{time}"
 
-            result = requests.get(
-                f"{TC_DEFAULT_URL}/metadata/{campaign}/{instrument}/{formatted_date}/{level}/{query_channel}")
-            metadata = result.json()
+            metadata, *metadatas = get_granules_metadata(
+                [(campaign, instrument, formatted_date, level, query_channel)] +
+                [(campaign, instrument, "_".join(g), level, c) for g in query_granules for c in query_channels])
 
-            mean = metadata["mean"]
-            stdev = metadata["stdev"]
+            if not _map_updates.is_current(session_id, ticket):
+                # a newer update of this session started while
+                # waiting on the tile server, its result wins
+                raise PreventUpdate
 
-            if is_combined_rgb:
-                min, max = 0, 100
-            else:
-                min, max = 0, mean + stdev
+            # the slider spans all the data, while the default
+            # stretch clips the outliers of every selected granule
+            min = np.min([m["range"][0] for m in metadatas]).item()
+            max = np.max([m["range"][1] for m in metadatas]).item()
+            default_stretch = percentile_stretch(metadatas, STRETCH_PERCENTILES)
 
             bounds = metadata["convex_hull"]["coordinates"][0]
             zoom_point = get_average_of_coordinates(bounds)
@@ -90,19 +115,19 @@ def register_map_callbacks(app):
                 "zoom": 10
             }
 
-            new_stretch_range = srng
+            # keep the user's stretch while the data range is unchanged
+            new_stretch_range = no_update
             is_new_range = curr_min != min or curr_max != max
 
             if is_new_range:
-                # just use our own computed min, max
-                new_stretch_range = [min, max]
-
-            marks = {floor(v): "{:.1f}".format(v) for v in new_stretch_range}
+                # just use our own computed stretch
+                new_stretch_range = default_stretch
 
             query_granules = [f"{campaign}/{instrument}/{"_".join(g)}/{level}" for g in query_granules]
             rgb_keys = RGB_KEYS if is_combined_rgb else None
 
-            url = combine_url(TC_DEFAULT_URL, query_granules, rgb_keys)
+            # colormap and stretch_range are appended client side
+            base_url = combine_url(TC_DEFAULT_URL, query_granules, rgb_keys, query_channel)
 
             # if is_combined_rgb:
             #     url = rgb_url(TC_URL, campaign, instrument, formatted_date, level, red_key="red",
@@ -111,8 +136,7 @@ def register_map_callbacks(app):
             #     url = singleband_url(TC_URL, campaign, instrument, formatted_date, level, channel, colormap=cmap.lower(
             #     ), stretch_range=new_stretch_range)
 
-            # two min-max exports, one for colorbar, one for slider
-            return url, cmap, min, max, "radiance", viewport_status, False, min, max, new_stretch_range, marks, is_combined_rgb
+            return base_url, viewport_status, False, min, max, new_stretch_range, is_combined_rgb
         # except Exception as e:
         #     print(f"center_bounds: failed to retrieve metadata for {instrument}/{formatted_date}")
         #     print(e)
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+
+from terracotta_client import get_client
+from config import (TC_DEFAULT_URL, METADATA_CACHE_SIZE, METADATA_CACHE_TTL,
+                    METADATA_FETCH_WORKERS)
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries also expire a
+    fixed number of seconds after they were stored
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry == None:
+                return None
+
+            value, expires = entry
+
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# granule metadata never changes after ingestion, so one
+# cache is shared by every callback in the process
+_metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+
+# lookups currently running against the tile server, so
+# concurrent callbacks asking for the same dataset share one
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_fetch_pool = ThreadPoolExecutor(max_workers=METADATA_FETCH_WORKERS)
+
+
+def get_granule_metadata(campaign, instrument, date, level, channel):
+    """
+    Returns the terracotta metadata of a dataset, only
+    querying the tile server on a cache miss. Concurrent
+    misses of the same dataset wait for a single request
+    """
+    key = (campaign, instrument, date, level, channel)
+    metadata = _metadata_cache.get(key)
+
+    if metadata != None:
+        return metadata
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_leader = future == None
+
+        if is_leader:
+            future = Future()
+            _in_flight[key] = future
+
+    if not is_leader:
+        return future.result()
+
+    try:
+        metadata = get_client(TC_DEFAULT_URL).metadata(campaign, instrument, date, level, channel)
+        _metadata_cache.put(key, metadata)
+        future.set_result(metadata)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+    return future.result()
+
+
+def get_granules_metadata(keys):
+    """
+    Returns the metadata of several (campaign, instrument,
+    date, level, channel) datasets, fetching the misses
+    concurrently
+    """
+    if len(keys) == 1:
+        return [get_granule_metadata(*keys[0])]
+
+    return list(_fetch_pool.map(lambda key: get_granule_metadata(*key), keys))
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+import threading
+
+
+class RequestSequencer:
+    """
+    Numbers the updates each browser session triggers, so an
+    update that finishes after a newer one has started can be
+    dropped instead of overwriting the newer result. Only the
+    maxsize most recently active sessions are remembered
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, session):
+        """
+        Starts an update of session and returns its ticket
+        """
+        with self._lock:
+            ticket = self._latest.get(session, 0) + 1
+            self._latest[session] = ticket
+            self._latest.move_to_end(session)
+
+            while len(self._latest) > self._maxsize:
+                self._latest.popitem(last=False)
+
+            return ticket
+
+    def is_current(self, session, ticket):
+        """
+        True while no later update of session has begun
+        """
+        with self._lock:
+            return self._latest.get(session, ticket) == ticket
@@ -1,15 +1,17 @@
 
 from datetime import datetime
-import requests
 
 from layouts.data_controller import create_granule_view
-from dash.dependencies import Output, Input, State
+from dash.dependencies import ClientsideFunction, Output, Input, State
 from dash.exceptions import PreventUpdate
-from utils import get_date_range, is_granule_selected
+from utils import is_granule_selected
+from dataset_catalog import DatasetCatalog
 from config import TC_LOCAL
 
 
 def register_ui_callbacks(app):
+    catalog = DatasetCatalog(TC_LOCAL)
+
     @app.callback(
         [
             Output("date-picker", "disabled_days"),
@@ -24,35 +26,17 @@ def register_ui_callbacks(app):
     )
     def compute_datepicker_state(selected_date):
         try:
-            print("disable_nodata_days: fetching datasets...")
-            result = requests.get(f"{TC_LOCAL}/datasets", timeout=10)
-            datasets = result.json()["datasets"]
-            total_dates = []
-
-            for dataset in datasets:
-                # remove "_" used to avoid url encoding space
-                # 1997-01-01_00:00:00 -> 1997-01-01 00:00:00
-                date = dataset["date"].replace("_", " ")
-                total_dates.append(datetime.fromisoformat(date))
-
-            min, max, unavailable = get_date_range(total_dates)
+            catalog.refresh()
+            min, max, unavailable = catalog.date_range()
 
             min = f"{min.year}-{min.month}-{min.day}"
             max = f"{max.year}-{max.month}-{max.day}"
-
-            for i in range(len(unavailable)):
-                date = unavailable[i]
-                unavailable[i] = f"{date.year}-{date.month}-{date.day}"
+            unavailable = [f"{date.year}-{date.month}-{date.day}" for date in unavailable]
 
             granules_on_date = []
 
             if selected_date != None:
-                for granule in total_dates:
-                    # get time component only
-                    time = str(granule).split(" ")[-1]
-
-                    if datetime.fromisoformat(selected_date).date() == granule.date() and time not in granules_on_date:
-                        granules_on_date.append(time)
+                granules_on_date = catalog.times_on(datetime.fromisoformat(selected_date).date())
 
             print("disable_nodata_days: computed new date ranges")
             return unavailable, min, max, False, "Choose Date", granules_on_date, False
@@ -60,22 +44,24 @@ def register_ui_callbacks(app):
             print("disable_nodata_days: failed to retrieve datasets!")
             return [], "1970-01-01", "1970-01-01", True, "Error getting datasets", [], True
 
-    @app.callback(Output("tc", "opacity"), Input("opacity", "value"))
-    def update_tile_opacity(opacity):
-        return [opacity]
+    # pure UI state, handled in the browser by assets/clientside.js
+    app.clientside_callback(
+        ClientsideFunction(namespace="ui", function_name="tile_opacity"),
+        Output("tc", "opacity"),
+        Input("opacity", "value")
+    )
 
-    @app.callback(Output("geolayer", "url"), Input("geolayer_selector", "value"))
-    def update_geolayer_tiles(value):
-        # fstring would bloat the template
-        prefix, postfix = "https://{s}.basemaps.cartocdn.com/rastertiles/", "/{z}/{x}/{y}{r}.png"
-        return prefix + value + postfix
+    app.clientside_callback(
+        ClientsideFunction(namespace="ui", function_name="geolayer_url"),
+        Output("geolayer", "url"),
+        Input("geolayer_selector", "value")
+    )
 
-    @app.callback(
+    app.clientside_callback(
+        ClientsideFunction(namespace="ui", function_name="add_button_disabled"),
         Output("add-granule-btn", "disabled"),
         Input("granules", "value")
     )
-    def update_selected_granules(selected_granule):
-        return selected_granule == None
     
     @app.callback(
         [Output("tile-layers", "children", allow_duplicate=True), Output("selected-granules-list", "children", allow_duplicate=True)],
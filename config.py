@@ -1,6 +1,35 @@
 # Server config.
 TC_DEFAULT_PORT = 5000
 DASH_DEFAULT_PORT = 7000
-# TC_HOST = "localhost"
+TC_HOST = "localhost"
 TC_DEFAULT_URL = f"https://demo-gunicorn.esi-cloud.org"
 TC_LOCAL = f"http://localhost:{TC_DEFAULT_PORT}"
+
+# Terracotta database shared by ingestion and the tile server.
+DB_NAME = "tc_db.sqlite"
+DB_PATH = "geospatial_data/database"
+# ingestion dumps its metrics here for the server's /metrics
+INGEST_METRICS_NAME = "ingest_metrics.json"
+
+# Granule metadata cache used by the map callbacks.
+METADATA_CACHE_SIZE = 1024
+METADATA_CACHE_TTL = 60 * 60  # seconds
+METADATA_FETCH_WORKERS = 8
+# map update sequence numbers are kept for this many sessions
+MAP_SESSIONS = 4096
+
+# Dash -> terracotta HTTP client.
+TC_POOL_SIZE = 16
+TC_RETRIES = 3
+TC_RETRY_BACKOFF = 0.3  # seconds, doubled on every retry
+TC_DEFAULT_TIMEOUT = 10  # seconds
+TC_TIMEOUTS = {"datasets": 10, "metadata": 5}
+
+# Date picker dataset catalog.
+CATALOG_REFRESH_INTERVAL = 30  # seconds
+CATALOG_PAGE_SIZE = 500
+CATALOG_CHANNEL = "red"
+
+# Default map stretch, percentiles of the selected granules'
+# data taken from the histograms stored at ingestion.
+STRETCH_PERCENTILES = (2, 98)
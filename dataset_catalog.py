@@ -0,0 +1,110 @@
+from bisect import bisect_left, insort
+from datetime import datetime
+import threading
+import time
+
+from terracotta_client import get_client
+from utils import get_date_range
+from config import CATALOG_PAGE_SIZE, CATALOG_REFRESH_INTERVAL, CATALOG_CHANNEL
+
+
+class DatasetCatalog:
+    """
+    Date indexed in-memory view of the granules served by a
+    terracotta server. Keeps a sorted list of days with data and
+    the granule times of each day, refreshed at most every
+    refresh_interval seconds by walking the paginated /datasets
+    listing and merging only what changed
+    """
+
+    def __init__(self, base_url, refresh_interval=CATALOG_REFRESH_INTERVAL,
+                 page_size=CATALOG_PAGE_SIZE, channel=CATALOG_CHANNEL):
+        self._client = get_client(base_url)
+        self._refresh_interval = refresh_interval
+        self._page_size = page_size
+        self._channel = channel
+        self._granules = set()
+        self._days = []
+        self._times = {}
+        self._date_range = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._last_refresh != None and \
+                    time.monotonic() - self._last_refresh < self._refresh_interval:
+                return
+
+            seen = set()
+            page = 0
+
+            while True:
+                # a single channel is enough to list every granule once
+                datasets = self._client.datasets(page=page, limit=self._page_size,
+                                                 channel=self._channel)["datasets"]
+
+                for dataset in datasets:
+                    seen.add(dataset["date"])
+
+                    if dataset["date"] not in self._granules:
+                        self._add(dataset["date"])
+
+                if len(datasets) < self._page_size:
+                    break
+
+                page += 1
+
+            for granule in self._granules - seen:
+                self._remove(granule)
+
+            self._last_refresh = time.monotonic()
+
+    def _parse(self, granule):
+        # remove "_" used to avoid url encoding space
+        # 1997-01-01_00:00:00 -> 1997-01-01 00:00:00
+        timestamp = datetime.fromisoformat(granule.replace("_", " "))
+        return timestamp.date(), str(timestamp.time())
+
+    def _add(self, granule):
+        day, granule_time = self._parse(granule)
+
+        if day not in self._times:
+            insort(self._days, day)
+            self._times[day] = []
+
+        insort(self._times[day], granule_time)
+        self._granules.add(granule)
+        self._date_range = None
+
+    def _remove(self, granule):
+        day, granule_time = self._parse(granule)
+
+        self._times[day].remove(granule_time)
+
+        if len(self._times[day]) == 0:
+            del self._times[day]
+            del self._days[bisect_left(self._days, day)]
+
+        self._granules.discard(granule)
+        self._date_range = None
+
+    def date_range(self):
+        """
+        Returns the first and last day with data and the days in
+        between without any, recomputed only after the index changed
+        """
+        with self._lock:
+            if self._date_range == None:
+                days = [datetime(day.year, day.month, day.day) for day in self._days]
+                self._date_range = get_date_range(days)
+
+            return self._date_range
+
+    def times_on(self, day):
+        """
+        Returns the sorted granule times available on a day
+        """
+        with self._lock:
+            return list(self._times.get(day, []))
+
@@ -0,0 +1,134 @@
+import os
+from xml.sax.saxutils import escape
+
+import numpy as np
+import rasterio
+
+from geospatial_data.l1_to_tiff import resample_slices, write_tiff
+
+# Stokes parameters and degree of linear polarization in L1C
+POLARIZATION_QUANTITIES = ["i", "q", "u", "dolp"]
+# nm, how far a view's wavelength may be from a requested one
+WAVELENGTH_TOLERANCE = 5
+
+GDAL_DATA_TYPES = {
+    "uint8": "Byte", "uint16": "UInt16", "int16": "Int16",
+    "uint32": "UInt32", "int32": "Int32",
+    "float32": "Float32", "float64": "Float64"
+}
+
+
+def band_key(quantity, view_index):
+    """
+    Terracotta channel key of an extracted band, e.g. "dolp_v12"
+    """
+    return f"{quantity}_v{view_index:02d}"
+
+
+def _view_wavelengths(l1_data, quantity):
+    wavelengths = l1_data.get("intensity_wavelength") if quantity in ["i", "q", "u"] \
+        else l1_data.get("polarization_wavelength", l1_data.get("intensity_wavelength"))
+
+    return None if wavelengths is None else np.asarray(wavelengths).reshape(len(wavelengths), -1)[:, 0]
+
+
+def select_bands(l1_data, quantities=("i",), views=None, wavelengths=None):
+    """
+    Resolves a band selection against a granule. views limits the
+    view indexes (all views if not given), wavelengths keeps only
+    views whose wavelength is within WAVELENGTH_TOLERANCE of one
+    of the given wavelengths in nm.
+    Returns a list of (band key, quantity, view index)
+    """
+    bands = []
+
+    for quantity in quantities:
+        if quantity not in POLARIZATION_QUANTITIES:
+            raise Exception(f"select_bands: Unknown polarization quantity '{quantity}'.")
+
+        view_count = l1_data[quantity].shape[2]
+        view_indexes = range(view_count) if views is None else [view for view in views if view < view_count]
+
+        if wavelengths is not None:
+            view_wavelengths = _view_wavelengths(l1_data, quantity)
+
+            if view_wavelengths is None:
+                raise Exception("select_bands: Granule has no wavelength information to select by.")
+
+            view_indexes = [view for view in view_indexes
+                            if np.min(np.abs(np.asarray(wavelengths) - view_wavelengths[view])) <= WAVELENGTH_TOLERANCE]
+
+        bands += [(band_key(quantity, view), quantity, view) for view in view_indexes]
+
+    return bands
+
+
+def write_band_vrt(source_file, band_index, vrt_path):
+    """
+    Writes a VRT exposing a single band of a multi-band raster as
+    band 1, which is the band terracotta serves. The VRT only
+    references the source, so no pixel data is duplicated
+    """
+    with rasterio.open(source_file) as source:
+        data_type = GDAL_DATA_TYPES[source.dtypes[band_index - 1]]
+        nodata = source.nodatavals[band_index - 1]
+        scale, offset = source.scales[band_index - 1], source.offsets[band_index - 1]
+        geotransform = ", ".join(repr(value) for value in source.transform.to_gdal())
+        srs = escape(source.crs.to_wkt())
+        width, height = source.width, source.height
+
+    nodata_element = f"    <NoDataValue>{nodata!r}</NoDataValue>\n" if nodata is not None else ""
+    # quantized bands keep their mapping back to radiance
+    scaling_elements = (f"    <Offset>{offset!r}</Offset>\n    <Scale>{scale!r}</Scale>\n"
+                        if (scale, offset) != (1.0, 0.0) else "")
+    relative_source = os.path.relpath(source_file, os.path.dirname(vrt_path))
+
+    with open(vrt_path, "w") as file:
+        file.write(
+            f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">\n'
+            f"  <SRS>{srs}</SRS>\n"
+            f"  <GeoTransform>{geotransform}</GeoTransform>\n"
+            f'  <VRTRasterBand dataType="{data_type}" band="1">\n'
+            f"{nodata_element}"
+            f"{scaling_elements}"
+            f"    <SimpleSource>\n"
+            f'      <SourceFilename relativeToVRT="1">{escape(relative_source)}</SourceFilename>\n'
+            f"      <SourceBand>{band_index}</SourceBand>\n"
+            f"    </SimpleSource>\n"
+            f"  </VRTRasterBand>\n"
+            f"</VRTDataset>\n")
+
+
+def write_band_vrts(export_file, keys):
+    """
+    Writes one VRT per band of a multi-band raster, named after
+    the raster and the band key.
+    Returns a list of (band key, VRT path)
+    """
+    outputs = []
+    prefix, _ = os.path.splitext(export_file)
+
+    for band_index, key in enumerate(keys, start=1):
+        vrt_path = f"{prefix}-{key}.vrt"
+        write_band_vrt(export_file, band_index, vrt_path)
+        outputs.append((key, vrt_path))
+
+    return outputs
+
+
+def extract_bands(l1_data, bands, export_file, max_radius=300, grid=None, **write_options):
+    """
+    Resamples every selected band of a granule with one neighbour
+    search and one vectorized gather, writes them as a single
+    multi-band raster and one VRT per band next to it.
+    bands comes from select_bands, write_options are forwarded
+    to write_tiff.
+    Returns a list of (band key, VRT path)
+    """
+    transform, resampled = resample_slices(
+        l1_data, [(quantity, view) for _, quantity, view in bands], max_radius, grid)
+
+    keys = [key for key, _, _ in bands]
+    write_tiff(export_file, transform, resampled, descriptions=keys, **write_options)
+
+    return write_band_vrts(export_file, keys)
@@ -0,0 +1,134 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from netCDF4 import Dataset
+
+from geospatial_data.bands import extract_bands, select_bands, write_band_vrts
+from geospatial_data.l1_to_tiff import l1_to_tiffs, prepare_grid, read_l1_data
+from geospatial_data.resamplers import DEFAULT_BACKEND, NeighbourCache
+from geospatial_data.statistics import dataset_metadata
+from geospatial_data.streaming import open_l1c, stream_l1_to_tiffs
+from metrics import collect_spans, span
+from utils import extract_granule_metadata
+
+BANDS_FILE = "bands.tif"
+
+
+def convert_granule(nc_path, output_dir, channel_indexes, max_radius=300, compress="deflate", blocksize=512,
+                    band_selection=None, max_memory_bytes=None, backend=DEFAULT_BACKEND,
+                    neighbour_cache_dir=None, workers=1, storage="float32"):
+    """
+    Converts a single L1 netCDF granule into one Cloud-Optimized
+    GeoTIFF per channel. Nothing in here touches the terracotta
+    driver, so it is safe to run inside a worker process while
+    a single writer performs the inserts.
+
+    band_selection optionally exports further view angles and
+    polarization quantities, given as the keyword arguments of
+    select_bands, into one multi-band COG with a key per band.
+    Setting max_memory_bytes converts in row blocks that stay
+    under that ceiling, with the neighbour search kept between
+    them but not the geolocation it is built from, instead of
+    reading the whole granule, and bounds the rasters read for
+    statistics to share it.
+    backend picks the in-memory neighbour search (row blocks
+    always use scipy's persistent tree), and neighbour_cache_dir
+    keeps its result so reconverting a granule skips the search.
+    workers bounds the threads writing, optimizing and computing
+    statistics of the channels at once, the neighbour search
+    and resampling are shared by all of them. storage picks the
+    stored pixel type, see quantization.STORAGE_TYPES.
+
+    Returns the granule metadata, a list of (channel, tiff path)
+    pairs, the terracotta metadata of every tiff path with its
+    histogram, ready to insert, and the seconds spent in each
+    conversion stage (read, resample, write, optimize and
+    statistics)
+    """
+    filename = os.path.basename(nc_path)
+    l1_meta = extract_granule_metadata(filename)
+
+    if l1_meta == None:
+        raise Exception(f"convert_granule: File '{filename}' has an unexpected naming convention.")
+
+    prefix, _ = os.path.splitext(filename)
+    granule_dir = os.path.join(output_dir, prefix)
+    os.makedirs(granule_dir, exist_ok=True)
+
+    outputs = []
+    export_files = {}
+
+    for channel, channel_index in channel_indexes.items():
+        tiff_path = os.path.join(granule_dir, f"{channel}-channel.tif")
+        export_files[tiff_path] = channel_index
+        outputs.append((channel, tiff_path))
+
+    neighbour_cache = NeighbourCache(neighbour_cache_dir, source=nc_path) if neighbour_cache_dir != None else None
+
+    with collect_spans() as timings:
+        if max_memory_bytes != None:
+            outputs += _stream_granule(nc_path, granule_dir, export_files, band_selection, max_radius,
+                                       max_memory_bytes, compress, blocksize, neighbour_cache, workers,
+                                       storage)
+        else:
+            outputs += _convert_in_memory(nc_path, granule_dir, export_files, band_selection, max_radius,
+                                          compress, blocksize, backend, neighbour_cache, workers, storage)
+
+        tiff_paths = [tiff_path for _, tiff_path in outputs]
+
+        # every worker holds one raster, so they split the ceiling
+        compute = partial(dataset_metadata,
+                          max_memory_bytes=max_memory_bytes // workers if max_memory_bytes != None else None)
+
+        with span("statistics"), ThreadPoolExecutor(max_workers=workers) as pool:
+            statistics = dict(zip(tiff_paths, pool.map(compute, tiff_paths)))
+
+    return l1_meta, outputs, statistics, dict(timings)
+
+
+def _convert_in_memory(nc_path, granule_dir, export_files, band_selection, max_radius,
+                       compress, blocksize, backend, neighbour_cache, workers, storage):
+    # TODO: change l1c constant to be based upon file name
+    #       once we are sure file naming is consistent
+    with span("read"):
+        l1_data = read_l1_data(nc_path, "l1c")
+
+    # every channel and band shares one target grid and neighbour
+    # search, and is written straight to COG without an intermediate file
+    grid = prepare_grid(l1_data, max_radius, backend, neighbour_cache)
+    l1_to_tiffs(l1_data, export_files, max_radius, grid, workers,
+                cog=True, compress=compress, blocksize=blocksize, storage=storage)
+
+    if band_selection == None:
+        return []
+
+    bands = select_bands(l1_data, **band_selection)
+
+    return extract_bands(l1_data, bands, os.path.join(granule_dir, BANDS_FILE), max_radius, grid,
+                         cog=True, compress=compress, blocksize=blocksize, storage=storage)
+
+
+def _stream_granule(nc_path, granule_dir, export_files, band_selection, max_radius,
+                    max_memory_bytes, compress, blocksize, neighbour_cache, workers, storage):
+    # channels and extra bands are written in the same pass
+    # over the row blocks, so the granule is only read once
+    rasters = {tiff_path: [("i", channel_index)] for tiff_path, channel_index in export_files.items()}
+    descriptions = {}
+    keys = []
+
+    if band_selection != None:
+        with Dataset(nc_path) as dataset:
+            bands = select_bands(open_l1c(dataset), **band_selection)
+
+        bands_file = os.path.join(granule_dir, BANDS_FILE)
+        keys = [key for key, _, _ in bands]
+        rasters[bands_file] = [(quantity, view_index) for _, quantity, view_index in bands]
+        descriptions[bands_file] = keys
+
+    stream_l1_to_tiffs(nc_path, rasters, max_radius, max_memory_bytes, cog=True,
+                       compress=compress, blocksize=blocksize, descriptions=descriptions,
+                       neighbour_cache=neighbour_cache, workers=workers, storage=storage)
+
+    return write_band_vrts(os.path.join(granule_dir, BANDS_FILE), keys) if len(keys) > 0 else []
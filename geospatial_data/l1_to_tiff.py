@@ -1,20 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
 import numpy as np
 import rasterio
 
-from rasterio.transform import from_gcps, from_origin, xy
+from rasterio.transform import from_gcps, from_origin
 from rasterio.control import GroundControlPoint as GCP
+from rasterio.io import MemoryFile
+from rio_cogeo.cogeo import cog_translate
 from pyresample import image, geometry, kd_tree
 from netCDF4 import Dataset
 from nasa_pace_data_reader import L1_AH2 as L1
 
+from geospatial_data.quantization import cog_profile, quantize_bands, storage_nodata
+from geospatial_data.resamplers import (DEFAULT_BACKEND, RESAMPLER_BACKENDS, filled, gather,
+                                        geometry_key, neighbour_search)
+from metrics import in_context, span
+
 import warnings
 warnings.filterwarnings("ignore")
 
 
 def resampleData(source_lats, source_lons, target_lats, target_lons,
                  source_data, max_radius, method='kd_tree_gauss',
-                 *args):
+                 *args, neighbour_cache=None):
     '''
     Parameters
     ----------
@@ -33,9 +41,14 @@ def resampleData(source_lats, source_lons, target_lats, target_lons,
     *args : TYPE
         DESCRIPTION.
     method : TYPE, optional
-        Method for resampling ['nearest_neighbor' or 'kd_tree_guass']. The default is 'nearest_neighbor'.
+        Method for resampling ['nearest_neighbor', 'kd_tree_guass' or a
+        RESAMPLER_BACKENDS name for nearest neighbour through that backend].
+        The default is 'nearest_neighbor'.
     *args : TYPE
         DESCRIPTION.
+    neighbour_cache : NeighbourCache, optional
+        Store of neighbour indexes for the RESAMPLER_BACKENDS methods, a
+        cached geometry skips the tree build.
 
     Returns
     -------
@@ -73,6 +86,26 @@ def resampleData(source_lats, source_lons, target_lats, target_lons,
         result = kd_tree.resample_gauss(
             swath_def, source_data, grid_def, radius_of_influence=max_radius, sigmas=max_radius/3)
 
+    # nearest neighbour split into a neighbour search, which
+    # can be cached, and a gather of the source data
+    elif method in RESAMPLER_BACKENDS:
+
+        key = geometry_key([source_lats, source_lons, target_lats, target_lons], (max_radius, method))
+        index = neighbour_cache.get(key) if neighbour_cache != None else None
+
+        if index is None:
+            index = neighbour_search(source_lats, source_lons, max_radius, method).query(target_lons, target_lats)
+
+            if neighbour_cache != None:
+                neighbour_cache.put(key, index)
+
+        # masked source pixels become NaN, pixels without a neighbour
+        # are 0 like ImageContainerNearest and the rest of the pipeline
+        result = gather(index, filled(source_data, "float64"), fill_value=0)
+
+    else:
+        raise Exception(f"resampleData: Unknown resampling method '{method}'.")
+
     # flaging the unknown data points to nans
     mask = np.ma.getmask(result)
     result[mask] = np.nan
@@ -95,57 +128,231 @@ def read_l1_data(import_file, l1_type="l1c"):
     return l1_data
 
 
-def l1_to_tiff(l1_data, export_file, angle_index=40):
-    # extract all related netcdf data
-    original_latitude = l1_data["latitude"]
-    original_longitude = l1_data["longitude"]
-    image_data = l1_data['i'][:, :, angle_index, 0]
-
-    width = original_latitude.shape[0]
-    height = original_latitude.shape[1]
+def compute_grid_transform(latitude, longitude):
+    """
+    Computes the affine transform of the target grid of a swath
+    from its corner coordinates.
+    Returns the transform and the (height, width) grid shape
+    """
+    width = latitude.shape[0]
+    height = latitude.shape[1]
 
     # use an array of Ground Control Points to create "anchors"
     # by which we can reproject the data by
     gcps = [
         # top-left corner
         GCP(row=0, col=0,
-            x=original_longitude[0, 0], y=original_latitude[0, 0]),
+            x=longitude[0, 0], y=latitude[0, 0]),
         # top-right corner
         GCP(row=0, col=width - 1,
-            x=original_longitude[0, -1], y=original_latitude[0, -1]),
+            x=longitude[0, -1], y=latitude[0, -1]),
         # bottom-left corner
         GCP(row=height - 1, col=0,
-            x=original_longitude[-1, 0], y=original_latitude[-1, 0]),
+            x=longitude[-1, 0], y=latitude[-1, 0]),
         # bottom-right corner
         GCP(row=height - 1, col=width - 1,
-            x=original_longitude[-1, -1], y=original_latitude[-1, -1]),
+            x=longitude[-1, -1], y=latitude[-1, -1]),
     ]
-    transform = from_gcps(gcps)
 
-    rows, cols = np.meshgrid(
-        np.arange(height), np.arange(width), indexing="ij")
-    xs, ys = xy(transform, rows.flatten(), cols.flatten())
+    return from_gcps(gcps), (height, width)
+
+
+def grid_coordinates(transform, width, row_start, row_stop, dtype="float32"):
+    """
+    Longitude and latitude of the pixel centers of rows
+    [row_start, row_stop) of a grid. The affine transform is
+    applied to 1-D row and column vectors and only broadcast
+    into the 2-D result, no meshgrid or coordinate lists
+    """
+    rows = np.arange(row_start, row_stop, dtype="float64") + 0.5
+    cols = np.arange(width, dtype="float64") + 0.5
+
+    longitude = np.add.outer((transform.b * rows + transform.c).astype(dtype),
+                             (transform.a * cols).astype(dtype))
+    latitude = np.add.outer((transform.e * rows + transform.f).astype(dtype),
+                            (transform.d * cols).astype(dtype))
+
+    return longitude, latitude
+
+
+def compute_target_grid(l1_data):
+    """
+    Computes the georeferenced target grid for a granule.
+    Returns the affine transform along with the target
+    latitude and longitude arrays
+    """
+    transform, (height, width) = compute_grid_transform(l1_data["latitude"], l1_data["longitude"])
+    transformed_longitude, transformed_latitude = grid_coordinates(transform, width, 0, height)
+
+    return transform, transformed_latitude, transformed_longitude
+
+
+def compute_neighbour_info(source_lats, source_lons, target_lats, target_lons, max_radius,
+                           backend=DEFAULT_BACKEND):
+    """
+    Runs the nearest neighbour search between a source swath and
+    a target grid once, so the result can be applied to any
+    number of data slices sharing that geometry.
+    Returns the flat source index of every target pixel
+    """
+    return neighbour_search(source_lats, source_lons, max_radius, backend).query(target_lons, target_lats)
+
+
+def resample_from_neighbour_info(neighbour_info, source_data):
+    """
+    Applies precomputed neighbour info to source data. Stacking
+    several slices on the last axis resamples all of them in a
+    single gather
+    """
+    # fill value mirrors ImageContainerNearest's default
+    return gather(neighbour_info, source_data, fill_value=0)
+
+
+def prepare_grid(l1_data, max_radius=300, backend=DEFAULT_BACKEND, neighbour_cache=None):
+    """
+    Computes the target grid of a granule and the neighbour info
+    mapping its swath onto it. The result can be passed as grid
+    to the conversion functions so they share one search.
+    With a neighbour_cache a granule seen before skips both
+    the target coordinates and the search
+    """
+    latitude, longitude = l1_data["latitude"], l1_data["longitude"]
+    transform, shape = compute_grid_transform(latitude, longitude)
+
+    key = geometry_key([latitude, longitude], (tuple(transform), shape, max_radius, backend))
+    neighbour_info = neighbour_cache.get(key) if neighbour_cache != None else None
+
+    if neighbour_info is None:
+        with span("resample"):
+            target_longitude, target_latitude = grid_coordinates(transform, shape[1], 0, shape[0])
+            neighbour_info = compute_neighbour_info(latitude, longitude, target_latitude,
+                                                    target_longitude, max_radius, backend)
 
-    transformed_longitude = np.array(xs).reshape((height, width))
-    transformed_latitude = np.array(ys).reshape((height, width))
+        if neighbour_cache != None:
+            neighbour_cache.put(key, neighbour_info)
 
-    metadata = {
+    return transform, neighbour_info
+
+
+def resample_slices(l1_data, slices, max_radius=300, grid=None):
+    """
+    Resamples several (quantity, view index) slices of a granule,
+    e.g. ("i", 40) or ("dolp", 12), onto the same target grid in
+    a single gather.
+    Returns the transform and an array of shape (bands, height, width)
+    """
+    transform, neighbour_info = grid or prepare_grid(l1_data, max_radius)
+
+    with span("resample"):
+        # np.stack drops masks, so fill values are turned into
+        # NaN per slice first, as ImageContainerNearest did
+        source_data = np.stack([filled(l1_data[quantity][:, :, view_index, 0])
+                                for quantity, view_index in slices], axis=-1)
+        resampled = resample_from_neighbour_info(neighbour_info, source_data)
+
+    return transform, np.moveaxis(resampled, -1, 0)
+
+
+def resample_channels(l1_data, angle_indexes, max_radius=300, grid=None):
+    """
+    Resamples several intensity view slices of a granule onto
+    the same target grid. The grid and the neighbour search are
+    computed once and shared by every requested slice.
+    Returns the transform and an array of shape (bands, height, width)
+    """
+    return resample_slices(l1_data, [("i", angle_index) for angle_index in angle_indexes],
+                           max_radius, grid)
+
+
+def _tiff_metadata(transform, image_data, count):
+    return {
         "driver": "GTiff",
-        "height": height,
-        "width": width,
-        "count": 1,
+        "height": image_data.shape[-2],
+        "width": image_data.shape[-1],
+        "count": count,
         "dtype": image_data.dtype,
         "crs": "EPSG:4326",
         "transform": transform,
     }
 
-    with rasterio.open(export_file, "w", **metadata) as dataset:
 
-        image_data = resampleData(original_latitude, original_longitude,
-                                  transformed_latitude, transformed_longitude,
-                                  image_data, max_radius=300, method='nearest_neighbor')
+def write_tiff(export_file, transform, image_data, cog=False, compress="deflate", blocksize=512,
+               descriptions=None, storage="float32"):
+    """
+    Writes a (height, width) or (bands, height, width) array to
+    disk. When cog is set the raster is assembled in memory and
+    written once as a tiled, compressed Cloud-Optimized GeoTIFF
+    with internal overviews. descriptions optionally names
+    every band. storage is one of quantization.STORAGE_TYPES,
+    uint16 bands carry the scale and offset back to radiance
+    """
+    if image_data.ndim == 2:
+        image_data = image_data[np.newaxis]
+
+    image_data, scales, offsets = quantize_bands(image_data, storage)
+    metadata = _tiff_metadata(transform, image_data, image_data.shape[0])
+    metadata["nodata"] = storage_nodata(storage)
+
+    if not cog:
+        with span("write"), rasterio.open(export_file, "w", **metadata) as dataset:
+            if descriptions != None:
+                dataset.descriptions = tuple(descriptions)
+
+            dataset.scales = scales
+            dataset.offsets = offsets
+
+            try:
+                dataset.write(image_data)
+            except Exception as e:
+                print("An error occured while writing to file:\n\t%s" % e)
+        return
+
+    profile = cog_profile(compress, blocksize, storage)
+
+    with MemoryFile() as memfile:
+        with memfile.open(**metadata) as dataset:
+            if descriptions != None:
+                dataset.descriptions = tuple(descriptions)
+
+            dataset.scales = scales
+            dataset.offsets = offsets
+
+            with span("write"):
+                dataset.write(image_data)
+
+            with span("optimize"):
+                cog_translate(dataset, export_file, profile, in_memory=True,
+                              overview_resampling="nearest", quiet=True)
+
+
+def l1_to_tiffs(l1_data, export_files, max_radius=300, grid=None, workers=1, **write_options):
+    """
+    Converts several view slices of the same granule into
+    single band GeoTIFFs in one resampling pass.
+    export_files maps each export path to its angle index.
+    Up to workers files are written at once, GDAL releases the
+    GIL while compressing. write_options are forwarded to write_tiff
+    """
+    export_paths = list(export_files.keys())
+    transform, bands = resample_channels(
+        l1_data, [export_files[path] for path in export_paths], max_radius, grid)
+
+    def write(export_file, image_data):
+        write_tiff(export_file, transform, image_data, **write_options)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # consuming the results raises the first failed write
+        list(pool.map(in_context(write), export_paths, bands))
+
+
+def l1_to_multiband_tiff(l1_data, export_file, angle_indexes, max_radius=300, grid=None, **write_options):
+    """
+    Converts several view slices of the same granule into
+    a single GeoTIFF holding one band per angle index
+    """
+    transform, bands = resample_channels(l1_data, angle_indexes, max_radius, grid)
+    write_tiff(export_file, transform, bands, **write_options)
+
 
-        try:
-            dataset.write(image_data, 1)
-        except Exception as e:
-            print("An error occured while writing to file:\n\t%s" % e)
+def l1_to_tiff(l1_data, export_file, angle_index=40, **write_options):
+    l1_to_tiffs(l1_data, {export_file: angle_index}, **write_options)
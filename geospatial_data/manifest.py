@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_NAME = "ingest_manifest.json"
+
+
+def file_fingerprint(path, content_hash=False):
+    """
+    Returns the size and modification time of a file and,
+    when requested, a sha1 digest of its contents
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if content_hash:
+        digest = hashlib.sha1()
+
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+
+        fingerprint["sha1"] = digest.hexdigest()
+
+    return fingerprint
+
+
+def _as_json(value):
+    # tuples become lists once saved, compare what is stored
+    return json.loads(json.dumps(value))
+
+
+class IngestManifest:
+    """
+    Persistent record of every ingested granule: where it came
+    from, what it looked like on disk, which conversion parameters
+    were used and which rasters were produced. Lets ingestion
+    reconvert only granules that are new or have changed
+    """
+
+    def __init__(self, path, content_hash=False):
+        self._path = path
+        self._content_hash = content_hash
+        self._entries = {}
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        """
+        Re-reads the manifest if it was rewritten since it was
+        last loaded, e.g. by an ingestion process. Cheap to call
+        often since it only stats the file when nothing changed
+        """
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            return False
+
+        if mtime == self._mtime:
+            return False
+
+        with open(self._path, "r") as file:
+            self._entries = json.load(file).get("granules", {})
+
+        self._mtime = mtime
+        return True
+
+    def save(self):
+        # write to a temporary file first so a crash mid-write
+        # never leaves a truncated manifest behind
+        temp_path = f"{self._path}.tmp"
+
+        with open(temp_path, "w") as file:
+            json.dump({"granules": self._entries}, file, indent=1)
+
+        os.replace(temp_path, self._path)
+        self._mtime = os.stat(self._path).st_mtime
+
+    def entries(self):
+        return dict(self._entries)
+
+    def get(self, source):
+        return self._entries.get(os.path.abspath(source))
+
+    def is_current(self, source, params):
+        """
+        Returns true if the source was ingested with the given
+        parameters and has not changed since
+        """
+        entry = self.get(source)
+
+        if entry == None or entry["params"] != _as_json(params):
+            return False
+
+        recorded = entry["fingerprint"]
+        current = file_fingerprint(source)
+
+        if current["size"] != recorded["size"]:
+            return False
+
+        if current["mtime"] == recorded["mtime"]:
+            return True
+
+        # file was touched, only the contents can tell
+        return self._content_hash and "sha1" in recorded and \
+            file_fingerprint(source, True)["sha1"] == recorded["sha1"]
+
+    def record(self, source, keys, params, outputs, footprint=None):
+        source = os.path.abspath(source)
+
+        self._entries[source] = {
+            "source": source,
+            "fingerprint": file_fingerprint(source, self._content_hash),
+            "params": _as_json(params),
+            "keys": keys,
+            "outputs": dict(outputs),
+            "footprint": footprint,
+            "ingested": time.time()
+        }
+
+    def remove(self, source):
+        return self._entries.pop(os.path.abspath(source), None)
+
+    def granule_versions(self):
+        """
+        Maps each "campaign/instrument/date/level" granule key to
+        the time it was last ingested
+        """
+        versions = {}
+
+        for entry in self._entries.values():
+            keys = entry["keys"]
+            granule = "/".join([keys["campaign"], keys["instrument"], keys["date"], keys["level"]])
+            versions[granule] = entry.get("ingested", 0)
+
+        return versions
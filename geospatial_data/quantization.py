@@ -0,0 +1,166 @@
+from concurrent.futures import Future
+import functools
+import os
+import threading
+
+import numpy as np
+
+# how rasters store radiance: float32 as resampled, or uint16
+# codes with a per band scale and offset
+STORAGE_TYPES = ["float32", "uint16"]
+UINT16_NODATA = 65535
+# floating point prediction for floats, horizontal differencing
+# for integers
+PREDICTORS = {"float32": 3, "uint16": 2}
+
+
+def check_storage(storage):
+    if storage not in STORAGE_TYPES:
+        raise Exception(f"check_storage: Unknown raster storage '{storage}'.")
+
+
+def storage_nodata(storage):
+    return UINT16_NODATA if storage == "uint16" else None
+
+
+def band_quantization(low, high, storage):
+    """
+    (scale, offset) mapping the stored values of a band holding
+    data between low and high back to radiance
+    """
+    if storage != "uint16" or not np.isfinite([low, high]).all():
+        return 1.0, 0.0
+
+    scale = (high - low) / (UINT16_NODATA - 1) if high > low else 1.0
+    return float(scale), float(low)
+
+
+def quantize(data, storage, scale=1.0, offset=0.0):
+    """
+    Converts radiance to the stored type, non-finite values
+    become the nodata value of uint16 storage
+    """
+    if storage != "uint16":
+        return data.astype(storage)
+
+    valid = np.isfinite(data)
+    stored = np.full(data.shape, UINT16_NODATA, dtype="uint16")
+    stored[valid] = np.clip(np.rint((data[valid] - offset) / scale), 0, UINT16_NODATA - 1)
+
+    return stored
+
+
+def quantize_bands(image_data, storage):
+    """
+    Quantizes a (bands, height, width) array, every band over its
+    own range. Returns the stored array, scales and offsets
+    """
+    check_storage(storage)
+
+    if storage != "uint16":
+        return image_data.astype(storage, copy=False), [1.0] * len(image_data), [0.0] * len(image_data)
+
+    stored = np.empty(image_data.shape, dtype=storage)
+    scales, offsets = [], []
+
+    for band, band_data in enumerate(image_data):
+        finite = band_data[np.isfinite(band_data)]
+        low, high = (finite.min(), finite.max()) if finite.size > 0 else (0.0, 0.0)
+        scale, offset = band_quantization(low, high, storage)
+
+        stored[band] = quantize(band_data, storage, scale, offset)
+        scales.append(scale)
+        offsets.append(offset)
+
+    return stored, scales, offsets
+
+
+def cog_profile(compress, blocksize, storage):
+    # imported here so the tile server never loads rio-cogeo
+    from rio_cogeo.profiles import cog_profiles
+
+    profile = cog_profiles.get(compress)
+    profile.update(blockxsize=blocksize, blockysize=blocksize, predictor=PREDICTORS[storage])
+
+    return profile
+
+
+def dequantize(data, scale=1.0, offset=0.0):
+    """
+    Radiance of stored (masked) tile data
+    """
+    if data.dtype == "float32" and scale == 1.0 and offset == 0.0:
+        return data
+
+    return data.astype("float32") * np.float32(scale) + np.float32(offset)
+
+
+def database_generation(driver):
+    """
+    Stamp of a file database, which every commit inserting or
+    deleting datasets rewrites. None when it has no file
+    """
+    try:
+        return os.stat(driver.meta_store.path).st_mtime_ns
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def scaled_tile_data(get_tile_data):
+    """
+    Wraps terracotta's get_tile_data so tiles are returned as
+    radiance, using the scale and offset stored in the dataset's
+    metadata at ingestion. They are cached per database and
+    dataset until the database file changes, databases without
+    a file are queried on every tile
+    """
+    scalings = {}
+    lock = threading.Lock()
+
+    def scaling(driver, keys):
+        generation = database_generation(driver)
+        key = (driver.meta_store.path, tuple(keys.values()) if isinstance(keys, dict) else tuple(keys))
+
+        with lock:
+            cached = scalings.get(key)
+
+        if generation != None and cached != None and cached[0] == generation:
+            return cached[1]
+
+        extra = driver.get_metadata(keys).get("metadata") or {}
+        result = (extra.get("scale", 1.0), extra.get("offset", 0.0))
+
+        if generation != None:
+            with lock:
+                scalings[key] = (generation, result)
+
+        return result
+
+    @functools.wraps(get_tile_data)
+    def wrapper(driver, keys, *args, **kwargs):
+        tile_data = get_tile_data(driver, keys, *args, **kwargs)
+        scale, offset = scaling(driver, keys)
+
+        if not isinstance(tile_data, Future):
+            return dequantize(tile_data, scale, offset)
+
+        scaled = Future()
+
+        def finish(future):
+            try:
+                scaled.set_result(dequantize(future.result(), scale, offset))
+            except Exception as e:
+                scaled.set_exception(e)
+
+        tile_data.add_done_callback(finish)
+        return scaled
+
+    wrapper.applies_scaling = True
+    return wrapper
+
+
+def install_tile_scaling():
+    from terracotta import xyz
+
+    if not getattr(xyz.get_tile_data, "applies_scaling", False):
+        xyz.get_tile_data = scaled_tile_data(xyz.get_tile_data)
@@ -0,0 +1,280 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+from pyresample import geometry, kd_tree
+from scipy.spatial import cKDTree
+
+# mean earth radius pyresample uses for its cartesian coordinates
+EARTH_RADIUS = 6370997.0
+DEFAULT_BACKEND = "pyresample"
+
+
+def filled(values, dtype="float32"):
+    """
+    Float array of possibly masked reader or netCDF data with
+    the masked pixels, e.g. fill values, set to NaN
+    """
+    return np.ma.filled(np.ma.asarray(values).astype(dtype), np.nan)
+
+
+def lonlat_to_cartesian(longitude, latitude):
+    """
+    Converts degrees to points on a sphere in meters, so chord
+    distances approximate ground distances at resampling radii
+    """
+    longitude = np.radians(longitude, dtype="float64")
+    latitude = np.radians(latitude, dtype="float64")
+    cos_latitude = np.cos(latitude)
+
+    return EARTH_RADIUS * np.stack([cos_latitude * np.cos(longitude),
+                                    cos_latitude * np.sin(longitude),
+                                    np.sin(latitude)], axis=-1)
+
+
+class PyresampleNeighbours:
+    """
+    Nearest neighbour search through pyresample's
+    get_neighbour_info, the reference implementation
+    """
+
+    def __init__(self, source_lats, source_lons, max_radius):
+        self._swath = geometry.SwathDefinition(lons=source_lons, lats=source_lats)
+        self._max_radius = max_radius
+
+    def query(self, target_lons, target_lats):
+        target = geometry.SwathDefinition(lons=target_lons, lats=target_lats)
+        valid_input_index, valid_output_index, index_array, _ = kd_tree.get_neighbour_info(
+            self._swath, target, self._max_radius, neighbours=1)
+
+        # index_array points into the valid inputs only,
+        # with their count marking "no neighbour"
+        valid_inputs = np.flatnonzero(valid_input_index)
+        found = index_array < len(valid_inputs)
+        outputs = np.flatnonzero(valid_output_index)
+
+        index = np.full(target.size, -1, dtype="int32")
+        index[outputs[found]] = valid_inputs[index_array[found]]
+
+        return index.reshape(target.shape)
+
+
+class ScipyNeighbours:
+    """
+    Nearest neighbour search with a SciPy cKDTree over the
+    valid source pixels, queried on every core
+    """
+
+    def __init__(self, source_lats, source_lons, max_radius):
+        valid = np.isfinite(source_lats) & np.isfinite(source_lons)
+
+        self._valid_inputs = np.flatnonzero(valid)
+        self._tree = cKDTree(lonlat_to_cartesian(source_lons[valid], source_lats[valid]))
+        self._max_radius = max_radius
+
+    def query(self, target_lons, target_lats):
+        points = lonlat_to_cartesian(target_lons, target_lats).reshape(-1, 3)
+        # the tree rejects non-finite points, they have no neighbour
+        finite = np.flatnonzero(np.isfinite(points).all(axis=1))
+        _, neighbours = self._tree.query(points[finite], k=1, distance_upper_bound=self._max_radius, workers=-1)
+
+        found = neighbours < len(self._valid_inputs)
+        index = np.full(len(points), -1, dtype="int32")
+        index[finite[found]] = self._valid_inputs[neighbours[found]]
+
+        return index.reshape(np.shape(target_lons))
+
+
+RESAMPLER_BACKENDS = {
+    "pyresample": PyresampleNeighbours,
+    "scipy": ScipyNeighbours
+}
+
+
+def neighbour_search(source_lats, source_lons, max_radius, backend=DEFAULT_BACKEND):
+    """
+    Builds the neighbour search of a source swath with the given
+    backend. Its query(target_lons, target_lats) returns the flat
+    source index of every target pixel, -1 where there is none
+    """
+    if backend not in RESAMPLER_BACKENDS:
+        raise Exception(f"neighbour_search: Unknown resampling backend '{backend}'.")
+
+    return RESAMPLER_BACKENDS[backend](source_lats, source_lons, max_radius)
+
+
+def gather(index, source_data, fill_value=0):
+    """
+    Picks the source pixel of every target pixel. source_data is
+    (rows, cols) or (rows, cols, bands), stacking bands gathers
+    all of them at once
+    """
+    source_data = np.asarray(source_data)
+    bands = source_data.shape[2:]
+    flat_source = source_data.reshape((-1,) + bands)
+
+    found = index >= 0
+    output = np.full(index.shape + bands, fill_value, dtype=source_data.dtype)
+    output[found] = flat_source[index[found]]
+
+    return output
+
+
+def geometry_key(arrays, description):
+    """
+    Hash identifying a neighbour search from the coordinate
+    arrays it depends on and a description of everything else,
+    e.g. the target transform, radius and backend
+    """
+    digest = hashlib.sha1()
+
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+
+    digest.update(repr(description).encode())
+
+    return digest.hexdigest()
+
+
+class NeighbourCache:
+    """
+    On-disk store of neighbour indexes keyed by geometry_key.
+    Indexes are saved as .npy and loaded memory-mapped, so
+    reprocessing a granule skips the tree build and only pages
+    in the rows it reads.
+
+    Every index records the source granule it was built for, so
+    remove_sources can drop the indexes of deleted granules, and
+    prune evicts indexes unused for max_age seconds and the least
+    recently used ones beyond max_bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, max_age=None, source=None):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._source = source
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, f"{key}.npy")
+
+    def _source_path(self, key):
+        return os.path.join(self._cache_dir, f"{key}.source")
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            index = np.load(path, mmap_mode="r")
+            # the modification time orders evictions
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return index
+
+    def create(self, key, shape):
+        """
+        Returns a writable memory-mapped index of the given shape,
+        published under key by commit once it is filled
+        """
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        return np.lib.format.open_memmap(f"{self._path(key)}.{os.getpid()}.tmp", mode="w+",
+                                         dtype="int32", shape=shape)
+
+    def commit(self, key, index):
+        index.flush()
+        os.replace(index.filename, self._path(key))
+
+        if self._source != None:
+            # a geometry shared by several granules keeps the last
+            with open(self._source_path(key), "w") as file:
+                file.write(os.path.abspath(self._source))
+
+    def discard(self, index):
+        """
+        Deletes an index from create that will not be committed
+        """
+        try:
+            os.remove(index.filename)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, index):
+        stored = self.create(key, index.shape)
+
+        try:
+            stored[:] = index
+            self.commit(key, stored)
+        except BaseException:
+            self.discard(stored)
+            raise
+
+    def remove(self, key):
+        for path in [self._path(key), self._source_path(key)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _entries(self):
+        # (modification time, key, size) of every index, oldest first
+        entries = []
+
+        if not os.path.isdir(self._cache_dir):
+            return entries
+
+        for file in os.listdir(self._cache_dir):
+            if not file.endswith(".npy"):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self._cache_dir, file))
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, file[:-len(".npy")], stat.st_size))
+
+        return sorted(entries)
+
+    def remove_sources(self, sources):
+        """
+        Drops the indexes built for any of the given granules
+        """
+        sources = {os.path.abspath(source) for source in sources}
+
+        for _, key, _ in self._entries():
+            try:
+                with open(self._source_path(key)) as file:
+                    source = file.read()
+            except FileNotFoundError:
+                continue
+
+            if source in sources:
+                self.remove(key)
+
+    def prune(self):
+        """
+        Evicts expired indexes, then the least recently used ones
+        until the cache fits max_bytes. Returns the evicted count
+        """
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        now = time.time()
+        evicted = 0
+
+        for mtime, key, size in entries:
+            expired = self._max_age != None and now - mtime > self._max_age
+
+            if not expired and (self._max_bytes == None or total <= self._max_bytes):
+                break
+
+            self.remove(key)
+            total -= size
+            evicted += 1
+
+        return evicted
@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+import rasterio
+from terracotta import raster
+
+HISTOGRAM_BINS = 64
+# histograms are computed from the closest overview
+# of at most this shape, not the full resolution raster
+HISTOGRAM_MAX_SHAPE = (1024, 1024)
+# bytes held per pixel while computing statistics: the masked
+# read, its mask and the valid values terracotta sorts
+STATISTICS_BYTES_PER_PIXEL = 16
+# resampling writes this outside the swath instead of nodata
+FILL_VALUE = 0.0
+
+
+def raster_histogram(path, bins=HISTOGRAM_BINS):
+    """
+    Compact histogram of band 1 of a raster over its valid range,
+    stored as {"range": [low, high], "counts": [...]} with
+    uniform bins. Fill outside the swath is left out
+    """
+    with rasterio.open(path) as dataset:
+        scale = max(dataset.height / HISTOGRAM_MAX_SHAPE[0], dataset.width / HISTOGRAM_MAX_SHAPE[1], 1)
+        out_shape = (max(1, round(dataset.height / scale)), max(1, round(dataset.width / scale)))
+        data = dataset.read(1, out_shape=out_shape, masked=True)
+        band_scale, band_offset = dataset.scales[0], dataset.offsets[0]
+
+    values = np.ma.compressed(data).astype("float64") * band_scale + band_offset
+    values = values[np.isfinite(values) & (values != FILL_VALUE)]
+
+    if len(values) == 0:
+        return None
+
+    low, high = float(values.min()), float(values.max())
+    counts, _ = np.histogram(values, bins, range=(low, high if high > low else low + 1))
+
+    return {"range": [low, high], "counts": counts.tolist()}
+
+
+def statistics_shape(height, width, max_memory_bytes):
+    """
+    Largest shape with the aspect of a height x width raster
+    whose statistics fit in max_memory_bytes, None when the
+    full resolution raster does
+    """
+    max_pixels = max(1, max_memory_bytes // STATISTICS_BYTES_PER_PIXEL)
+
+    if height * width <= max_pixels:
+        return None
+
+    scale = math.sqrt(height * width / max_pixels)
+    return (max(1, int(height / scale)), max(1, int(width / scale)))
+
+
+def dataset_metadata(path, max_memory_bytes=None):
+    """
+    Terracotta metadata of a raster (range, percentiles, mean,
+    stdev, footprint) with its histogram as extra metadata.
+    Needs no driver, so it runs in the conversion workers and
+    the single writer only has to insert the result.
+    Statistics of quantized rasters are converted to radiance,
+    and their scale and offset are kept for the tile server.
+    With max_memory_bytes, rasters too large to fit are read
+    decimated, so the statistics are approximate
+    """
+    extra_metadata = {"histogram": raster_histogram(path)}
+
+    with rasterio.open(path) as dataset:
+        scale, offset = dataset.scales[0], dataset.offsets[0]
+        max_shape = (statistics_shape(dataset.height, dataset.width, max_memory_bytes)
+                     if max_memory_bytes != None else None)
+
+    if (scale, offset) != (1.0, 0.0):
+        extra_metadata.update(scale=scale, offset=offset)
+
+    metadata = raster.compute_metadata(path, extra_metadata=extra_metadata, max_shape=max_shape)
+
+    metadata["range"] = [value * scale + offset for value in metadata["range"]]
+    metadata["percentiles"] = np.asarray(metadata["percentiles"]) * scale + offset
+    metadata["mean"] = metadata["mean"] * scale + offset
+    metadata["stdev"] = metadata["stdev"] * scale
+
+    return metadata
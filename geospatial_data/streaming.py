@@ -0,0 +1,262 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import rasterio
+from netCDF4 import Dataset
+from rasterio.windows import Window
+from rio_cogeo.cogeo import cog_translate
+
+from geospatial_data.l1_to_tiff import compute_grid_transform, grid_coordinates
+from geospatial_data.quantization import (band_quantization, check_storage, cog_profile, quantize,
+                                          storage_nodata)
+from geospatial_data.resamplers import ScipyNeighbours, filled, geometry_key
+from metrics import in_context, span
+
+# netCDF groups of the L1C variables the conversion reads
+GEOLOCATION_GROUP = "geolocation_data"
+OBSERVATION_GROUP = "observation_data"
+SENSOR_GROUP = "sensor_views_bands"
+MAX_MEMORY_BYTES = 512 * 2**20
+# rough bytes held per target pixel of a row block: coordinates,
+# cartesian points, distances, indexes and one gathered band
+BLOCK_BYTES_PER_PIXEL = 112
+# rough bytes held per source pixel by the neighbour search while
+# the row blocks are resampled: cartesian points, the KD-tree's
+# indexes and nodes, and the index of every valid pixel
+SEARCH_BYTES_PER_PIXEL = 48
+# and while it is built from latitude and longitude, which are
+# only held until then. Not split into blocks, see stream_l1_to_tiffs
+SEARCH_BUILD_BYTES_PER_PIXEL = 96
+
+
+def open_l1c(dataset):
+    """
+    Lazy view of an open L1C netCDF dataset shaped like the dict
+    read_l1_data returns. Geolocation and observation variables
+    are only read when sliced, wavelengths are read eagerly
+    """
+    geolocation = dataset.groups[GEOLOCATION_GROUP]
+    l1_data = {
+        "latitude": geolocation.variables["latitude"],
+        "longitude": geolocation.variables["longitude"]
+    }
+
+    for name, variable in dataset.groups[OBSERVATION_GROUP].variables.items():
+        l1_data[name] = variable
+
+    if SENSOR_GROUP in dataset.groups:
+        for name in ["intensity_wavelength", "polarization_wavelength"]:
+            if name in dataset.groups[SENSOR_GROUP].variables:
+                l1_data[name] = dataset.groups[SENSOR_GROUP].variables[name][:]
+
+    return l1_data
+
+
+def block_rows_for(width, max_memory_bytes, held_bytes=0):
+    """
+    Number of target rows resampled at once so the working set of
+    a block, on top of held_bytes kept for the whole conversion,
+    stays under max_memory_bytes
+    """
+    return max(1, int((max_memory_bytes - held_bytes) // (width * BLOCK_BYTES_PER_PIXEL)))
+
+
+def gather_slice(variable, view_index, index, source_width):
+    """
+    Reads only the source rows a block of neighbour indexes
+    refers to from a (rows, cols, views, bands) variable and
+    gathers them. Pixels without a neighbour are set to 0,
+    like the in-memory resampler
+    """
+    found = index >= 0
+    output = np.zeros(index.shape, dtype="float32")
+
+    if not found.any():
+        return output
+
+    source_rows, source_cols = np.divmod(index[found], source_width)
+    row_start, row_stop = source_rows.min(), source_rows.max() + 1
+
+    with span("read"):
+        source = filled(variable[row_start:row_stop, :, view_index, 0])
+
+    with span("resample"):
+        output[found] = source[source_rows - row_start, source_cols]
+
+    return output
+
+
+def _open_output(export_file, transform, shape, count, scratch, blocksize, descriptions):
+    # COGs need their overviews built from the finished raster and
+    # quantization needs every band's range, so blocks then go to
+    # a tiled float32 scratch GeoTIFF that is converted after
+    path = f"{export_file}.partial.tif" if scratch else export_file
+
+    dataset = rasterio.open(path, "w", driver="GTiff", height=shape[0], width=shape[1],
+                            count=count, dtype="float32", crs="EPSG:4326", transform=transform,
+                            tiled=True, blockxsize=blocksize, blockysize=blocksize, BIGTIFF="IF_SAFER")
+
+    if descriptions != None:
+        dataset.descriptions = tuple(descriptions)
+
+    return dataset
+
+
+def _update_range(band_range, band_data):
+    finite = band_data[np.isfinite(band_data)]
+
+    if finite.size > 0:
+        band_range[0] = min(band_range[0], finite.min())
+        band_range[1] = max(band_range[1], finite.max())
+
+
+def quantize_raster(source_file, target_file, storage, ranges, block_rows):
+    """
+    Copies a float32 raster block by block into the given storage
+    type, quantizing every band over its (low, high) range
+    """
+    with rasterio.open(source_file) as source:
+        profile = source.profile
+        profile.update(dtype=storage, nodata=storage_nodata(storage))
+        quantization = [band_quantization(low, high, storage) for low, high in ranges]
+
+        with rasterio.open(target_file, "w", **profile) as target:
+            if any(source.descriptions):
+                target.descriptions = source.descriptions
+
+            target.scales = [scale for scale, _ in quantization]
+            target.offsets = [offset for _, offset in quantization]
+
+            for row_start in range(0, source.height, block_rows):
+                window = Window(0, row_start, source.width, min(block_rows, source.height - row_start))
+
+                for band, (scale, offset) in enumerate(quantization, start=1):
+                    target.write(quantize(source.read(band, window=window), storage, scale, offset),
+                                 band, window=window)
+
+
+def stream_l1_to_tiffs(nc_path, rasters, max_radius=300, max_memory_bytes=MAX_MEMORY_BYTES,
+                       cog=False, compress="deflate", blocksize=512, descriptions=None,
+                       neighbour_cache=None, workers=1, storage="float32"):
+    """
+    Memory-bounded conversion of an L1C granule. Only geolocation
+    is read up front, observation slices are read lazily per row
+    block and every block is written to its window in the output.
+    rasters maps each export path to a list of (quantity, view
+    index) slices, one band each. descriptions optionally maps
+    export paths to their band names.
+    The search is queried once per block, so it always uses the
+    scipy backend, whose tree is built once per granule and kept
+    between queries (pyresample rebuilds it on every query).
+    Blocks are read on one thread, netCDF/HDF5 is not thread
+    safe, but up to workers rasters are turned into COGs at once.
+    storage is one of quantization.STORAGE_TYPES.
+    max_memory_bytes bounds the row blocks together with the search
+    kept between them. The full geolocation and building the
+    search from it come first and are not split, they take about
+    SEARCH_BUILD_BYTES_PER_PIXEL per source pixel, which is
+    reported when over the ceiling
+    """
+    check_storage(storage)
+    scratch = cog or storage != "float32"
+
+    with Dataset(nc_path) as dataset:
+        l1_data = open_l1c(dataset)
+
+        with span("read"):
+            latitude = filled(l1_data["latitude"][:])
+            longitude = filled(l1_data["longitude"][:])
+
+        transform, (height, width) = compute_grid_transform(latitude, longitude)
+        source_width = latitude.shape[1]
+
+        key = geometry_key([latitude, longitude], (tuple(transform), (height, width), max_radius, "scipy"))
+        cached = neighbour_cache.get(key) if neighbour_cache != None else None
+        stored = None
+        search = None
+        search_bytes = 0
+
+        if cached is None:
+            if latitude.size * SEARCH_BUILD_BYTES_PER_PIXEL > max_memory_bytes:
+                print(f"stream_l1_to_tiffs: building the neighbour search of {os.path.basename(nc_path)} "
+                      f"takes about {latitude.size * SEARCH_BUILD_BYTES_PER_PIXEL / 2**20:.0f} MiB, "
+                      f"over the {max_memory_bytes / 2**20:.0f} MiB ceiling")
+
+            with span("resample"):
+                search = ScipyNeighbours(latitude, longitude, max_radius)
+
+            search_bytes = latitude.size * SEARCH_BYTES_PER_PIXEL
+
+        # the search holds everything needed from the geolocation
+        del latitude, longitude
+
+        # blocks share the ceiling with the search kept between them
+        block_rows = block_rows_for(width, max_memory_bytes, search_bytes)
+        outputs = {export_file: _open_output(export_file, transform, (height, width), len(slices), scratch,
+                                             blocksize, (descriptions or {}).get(export_file))
+                   for export_file, slices in rasters.items()}
+        ranges = {export_file: [[np.inf, -np.inf] for _ in slices] for export_file, slices in rasters.items()}
+
+        if cached is None and neighbour_cache != None:
+            stored = neighbour_cache.create(key, (height, width))
+
+        try:
+            for row_start in range(0, height, block_rows):
+                row_stop = min(row_start + block_rows, height)
+
+                if cached is None:
+                    with span("resample"):
+                        index = search.query(*grid_coordinates(transform, width, row_start, row_stop))
+                else:
+                    index = np.asarray(cached[row_start:row_stop])
+
+                if stored is not None:
+                    stored[row_start:row_stop] = index
+
+                window = Window(0, row_start, width, row_stop - row_start)
+
+                for export_file, slices in rasters.items():
+                    for band, (quantity, view_index) in enumerate(slices, start=1):
+                        band_data = gather_slice(l1_data[quantity], view_index, index, source_width)
+                        _update_range(ranges[export_file][band - 1], band_data)
+
+                        with span("write"):
+                            outputs[export_file].write(band_data, band, window=window)
+
+            if stored is not None:
+                neighbour_cache.commit(key, stored)
+                stored = None
+        finally:
+            for output in outputs.values():
+                output.close()
+
+            if stored is not None:
+                # a failed conversion leaves no partial index behind
+                neighbour_cache.discard(stored)
+
+    if not scratch:
+        return
+
+    profile = cog_profile(compress, blocksize, storage)
+
+    def finish(export_file):
+        source_file = f"{export_file}.partial.tif"
+
+        if storage != "float32":
+            quantized_file = f"{export_file}.quantized.tif" if cog else export_file
+
+            with span("write"):
+                quantize_raster(source_file, quantized_file, storage, ranges[export_file], block_rows)
+
+            os.remove(source_file)
+            source_file = quantized_file
+
+        if cog:
+            with span("optimize"):
+                cog_translate(source_file, export_file, profile.copy(), in_memory=False,
+                              overview_resampling="nearest", quiet=True)
+            os.remove(source_file)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(in_context(finish), rasters))
@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    # fall back to polling the directory
+    INotify = None
+
+
+class GranuleWatcher:
+    """
+    Watches a directory for newly arriving (or rewritten) netCDF
+    granules and hands each completed file to a callback on a
+    background thread. Uses inotify when inotify_simple is
+    installed, otherwise polls the directory and waits for a
+    file's size and mtime to settle before queueing it
+    """
+
+    def __init__(self, watch_path, on_granule, poll_interval=5.0, use_inotify=True):
+        if not os.path.isdir(watch_path):
+            raise Exception(f"GranuleWatcher: '{watch_path}' is not a directory.")
+
+        self._watch_path = watch_path
+        self._on_granule = on_granule
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify and INotify != None
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        watch = self._watch_inotify if self._use_inotify else self._watch_polling
+
+        self._threads = [
+            threading.Thread(target=watch, name="granule-watch", daemon=True),
+            threading.Thread(target=self._ingest_loop, name="granule-ingest", daemon=True)
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+        mode = "inotify" if self._use_inotify else f"polling every {self._poll_interval}s"
+        print(f"GranuleWatcher.start: watching {self._watch_path} ({mode})")
+
+    def stop(self):
+        self._stop.set()
+
+        for thread in self._threads:
+            thread.join()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _is_granule(self, name):
+        return name.split(".")[-1] == "nc"
+
+    def _watch_inotify(self):
+        inotify = INotify()
+        inotify.add_watch(self._watch_path, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+        while not self._stop.is_set():
+            # wake up every second to check for shutdown
+            for event in inotify.read(timeout=1000):
+                if self._is_granule(event.name):
+                    self._queue.put(os.path.join(self._watch_path, event.name))
+
+        inotify.close()
+
+    def _watch_polling(self):
+        pending = {}
+        queued = {}
+
+        while not self._stop.is_set():
+            for entry in os.scandir(self._watch_path):
+                if not entry.is_file() or not self._is_granule(entry.name):
+                    continue
+
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime)
+
+                if queued.get(entry.path) == signature:
+                    continue
+
+                # only queue once the file stopped changing between
+                # two polls, it may still be copied in otherwise
+                if pending.get(entry.path) == signature:
+                    queued[entry.path] = signature
+                    del pending[entry.path]
+                    self._queue.put(entry.path)
+                else:
+                    pending[entry.path] = signature
+
+            self._stop.wait(self._poll_interval)
+
+    def _ingest_loop(self):
+        while not self._stop.is_set():
+            try:
+                nc_path = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                self._on_granule(nc_path)
+            except Exception as e:
+                print(f"GranuleWatcher._ingest_loop: failed to ingest {os.path.basename(nc_path)}: {e}")
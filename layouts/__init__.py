@@ -6,4 +6,5 @@ def apply_layout(app):
     Setups the root layout component on the app
     """
     app.title = "UMBC | Geospatial Data Explorer"
-    app.layout = create_root()
+    # a function, so dash builds the layout on every page load
+    app.layout = create_root
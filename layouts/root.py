@@ -1,5 +1,7 @@
+import uuid
+
 import dash_leaflet as dl
-from dash import html
+from dash import dcc, html
 
 from .branding import create_branding
 from .data_controller import create_data_controller
@@ -8,7 +10,8 @@ from .granule_data_view import create_granule_data_view
 
 def create_root():
     """
-    Returns the root layout for the application
+    Returns the root layout for the application, built per
+    page load so every session gets its own id
     """
 
     return html.Div(
@@ -26,5 +29,8 @@ def create_root():
             ], style={"width": "100%", "height": "100%"}),
             # create_granule_data_view(),
             create_data_controller(),
-            create_branding()
+            create_branding(),
+            dcc.Store(id="session-id", data=str(uuid.uuid4())),
+            # tile url of the selected datasets, styled client side
+            dcc.Store(id="tc-base-url")
         ], style={"display": "grid", "width": "100%", "height": "100vh"})
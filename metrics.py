@@ -0,0 +1,282 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+import contextvars
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# seconds, spans range from sub-millisecond tile stages
+# to whole granule conversions
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_string(labels):
+    if len(labels) == 0:
+        return ""
+
+    pairs = ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == math.inf else repr(value)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {"type": "counter", "help": self.help,
+                    "samples": [[list(key), value] for key, value in self._values.items()]}
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._buckets = sorted(buckets) + [math.inf]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self._buckets), 0.0))
+
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self._values[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {"type": "histogram", "help": self.help, "buckets": self._buckets[:-1],
+                    "samples": [[list(key), counts[:], total] for key, (counts, total) in self._values.items()]}
+
+
+class Registry:
+    """
+    Process-local collection of metrics, rendered in the
+    Prometheus text exposition format. Snapshots can be written
+    to disk so metrics of another process (ingestion) are
+    served alongside the tile server's own
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+
+            return self._metrics[name]
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def dump(self, path):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temp_path, "w") as file:
+            json.dump(self.snapshot(), file)
+
+        os.replace(temp_path, path)
+
+    def render(self, snapshot_paths=None):
+        """
+        Prometheus text format of this registry, plus the dumped
+        snapshots in snapshot_paths, which map a process label
+        to the path of its snapshot
+        """
+        sources = [({}, self.snapshot())]
+
+        for process, path in (snapshot_paths or {}).items():
+            try:
+                with open(path) as file:
+                    sources.append(({"process": process}, json.load(file)))
+            except (FileNotFoundError, ValueError):
+                continue
+
+        # every sample of a metric must follow its HELP and TYPE
+        # lines, so the sources are grouped by metric name
+        families = {}
+
+        for extra_labels, snapshot in sources:
+            for name, metric in snapshot.items():
+                families.setdefault(name, []).append((extra_labels, metric))
+
+        lines = []
+
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family[0][1]['help']}")
+            lines.append(f"# TYPE {name} {family[0][1]['type']}")
+
+            for extra_labels, metric in family:
+                lines += _render_samples(name, metric, extra_labels)
+
+        return "\n".join(lines) + "\n"
+
+
+def _render_samples(name, metric, extra_labels):
+    lines = []
+
+    for sample in metric["samples"]:
+        labels = [tuple(pair) for pair in sample[0]] + list(extra_labels.items())
+
+        if metric["type"] == "counter":
+            lines.append(f"{name}{_label_string(labels)} {_format_value(sample[1])}")
+            continue
+
+        counts, total = sample[1], sample[2]
+
+        for bound, count in zip(metric["buckets"] + [math.inf], counts):
+            bucket_labels = labels + [("le", _format_value(bound))]
+            lines.append(f"{name}_bucket{_label_string(bucket_labels)} {count}")
+
+        lines.append(f"{name}_sum{_label_string(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_label_string(labels)} {counts[-1]}")
+
+    return lines
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "paceharp2_stage_seconds", "Time spent in each ingestion and tile rendering stage")
+REQUEST_SECONDS = REGISTRY.histogram(
+    "paceharp2_request_seconds", "Tile server request latency by endpoint")
+REQUESTS = REGISTRY.counter(
+    "paceharp2_requests_total", "Tile server requests by endpoint and status")
+
+# span collectors active in the current context, see collect_spans
+_collectors = contextvars.ContextVar("span_collectors", default=())
+_collectors_lock = threading.Lock()
+
+
+@contextmanager
+def span(stage):
+    """
+    Times the enclosed block as one run of an ingestion or tile
+    rendering stage
+    """
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        _record_span(stage, time.perf_counter() - start)
+
+
+def _record_span(stage, elapsed, collectors=None):
+    collectors = _collectors.get() if collectors == None else collectors
+
+    # inside collect_spans the stage total is observed once the
+    # work is done, so every path observes one value per granule
+    if len(collectors) == 0:
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        return
+
+    with _collectors_lock:
+        for collector in collectors:
+            collector[stage] = collector.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def collect_spans():
+    """
+    Yields a dict summing the seconds of every span finished in
+    this context (this thread, and pool threads running
+    functions wrapped by in_context) while the block runs,
+    instead of observing them. The owner observes the totals
+    with observe_stages, possibly in another process
+    """
+    collector = {}
+    token = _collectors.set(_collectors.get() + (collector,))
+
+    try:
+        yield collector
+    finally:
+        _collectors.reset(token)
+
+
+def in_context(function):
+    """
+    Wraps function to run in a copy of the current context, so
+    spans it finishes on a pool thread reach the collectors of
+    the thread that submitted it
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapper
+
+
+def observe_stages(timings):
+    """
+    Records stage totals gathered by collect_spans
+    """
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def timed(stage, function):
+    """
+    Wraps function in a span of stage. A function returning a
+    Future is timed until the future completes, not only until
+    its work was submitted
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException:
+            _record_span(stage, time.perf_counter() - start)
+            raise
+
+        if isinstance(result, Future):
+            # the callback may run on another thread
+            collectors = _collectors.get()
+            result.add_done_callback(lambda _: _record_span(stage, time.perf_counter() - start, collectors))
+        else:
+            _record_span(stage, time.perf_counter() - start)
+
+        return result
+
+    wrapper.span_stage = stage
+    return wrapper
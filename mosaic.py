@@ -0,0 +1,184 @@
+import json
+import threading
+
+import numpy as np
+from flask import request, send_file
+from terracotta import exceptions, get_driver, image, xyz
+
+from config import STRETCH_PERCENTILES
+from geospatial_data.manifest import IngestManifest
+from spatial_index import STRTree
+from utils import hull_polygon, percentile_stretch, polygon_intersects_box, tile_bounds
+
+TILE_SIZE = (256, 256)
+DEFAULT_CHANNEL = "red"
+
+
+class FootprintIndex:
+    """
+    STR-tree of the granule footprints recorded in the ingest
+    manifest at ingestion time. Rebuilt whenever the manifest
+    is rewritten so newly ingested granules are found
+    """
+
+    def __init__(self, manifest_path):
+        self._manifest_path = manifest_path
+        self._manifest = None
+        self._tree = STRTree([])
+        self._hulls = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        if self._manifest == None:
+            self._manifest = IngestManifest(self._manifest_path)
+        elif not self._manifest.reload():
+            return
+
+        items = []
+        hulls = {}
+
+        for entry in self._manifest.entries().values():
+            footprint = entry.get("footprint")
+
+            if footprint == None:
+                continue
+
+            keys = entry["keys"]
+            granule = "/".join([keys["campaign"], keys["instrument"], keys["date"], keys["level"]])
+            items.append((footprint["bounds"], granule))
+            hulls[granule] = hull_polygon(footprint["convex_hull"])
+
+        self._tree = STRTree(items)
+        self._hulls = hulls
+
+    def intersecting(self, granules, bounds):
+        """
+        Returns the granules, in their given order, whose footprint
+        intersects the (west, south, east, north) bounds. Granules
+        without a recorded footprint are always kept
+        """
+        with self._lock:
+            self._refresh()
+            tree, hulls = self._tree, self._hulls
+
+        hits = set(tree.query(bounds))
+
+        return [granule for granule in granules
+                if granule not in hulls or
+                (granule in hits and polygon_intersects_box(hulls[granule], *bounds))]
+
+
+def _mosaic_band(driver, granules, channel, tile_xyz):
+    """
+    Composites one channel of several granules into a single tile.
+    Earlier granules take priority, later ones only fill pixels
+    that are still empty, and reading stops once the tile is full
+    """
+    mosaic = np.ma.masked_all(TILE_SIZE, dtype="float64")
+    used = []
+
+    for granule in granules:
+        try:
+            tile_data = xyz.get_tile_data(driver, granule.split("/") + [channel],
+                                          tile_xyz, tile_size=TILE_SIZE)
+        except exceptions.TileOutOfBoundsError:
+            continue
+
+        empty = np.ma.getmaskarray(mosaic) & ~np.ma.getmaskarray(tile_data)
+        mosaic[empty] = tile_data[empty]
+        used.append(granule)
+
+        if not np.ma.getmaskarray(mosaic).any():
+            break
+
+    return mosaic, used
+
+
+def _stretch_range(driver, granules, channel):
+    # same percentile stretch the map defaults to, shared by
+    # every granule in the tile so seams do not show
+    metadatas = [driver.get_metadata(granule.split("/") + [channel]) for granule in granules]
+
+    return percentile_stretch(metadatas, STRETCH_PERCENTILES)
+
+
+def render_mosaic(driver, index, granules, tile_xyz, channel=DEFAULT_CHANNEL,
+                  rgb_keys=None, colormap=None, stretch_range=None):
+    """
+    Renders a PNG tile of several granules, only reading the
+    ones whose footprint intersects the tile
+    """
+    x, y, z = tile_xyz
+    candidates = index.intersecting(granules, tile_bounds(x, y, z))
+
+    if len(candidates) == 0:
+        return image.empty_image(TILE_SIZE)
+
+    with driver.connect():
+        if rgb_keys == None:
+            band, used = _mosaic_band(driver, candidates, channel, tile_xyz)
+
+            if len(used) == 0:
+                return image.empty_image(TILE_SIZE)
+
+            stretch = stretch_range or _stretch_range(driver, used, channel)
+            return image.array_to_png(image.to_uint8(band, *stretch), colormap=colormap)
+
+        out = np.ma.zeros(TILE_SIZE + (3,), dtype="uint8")
+
+        for i, rgb_channel in enumerate(rgb_keys):
+            band, used = _mosaic_band(driver, candidates, rgb_channel, tile_xyz)
+
+            if len(used) == 0:
+                return image.empty_image(TILE_SIZE)
+
+            stretch = stretch_range or _stretch_range(driver, used, rgb_channel)
+            out[..., i] = image.to_uint8(band, *stretch)
+
+        return image.array_to_png(out)
+
+
+def _check_combine_args(granules, rgb_keys, stretch_range):
+    if not isinstance(granules, list) or not all(isinstance(granule, str) for granule in granules):
+        raise exceptions.InvalidArgumentsError("keys_list must be a list of granule keys")
+
+    if rgb_keys != None and (not isinstance(rgb_keys, list) or len(rgb_keys) != 3):
+        raise exceptions.InvalidArgumentsError("rgb_keys must hold the red, green and blue channel")
+
+    if stretch_range != None and (not isinstance(stretch_range, list) or len(stretch_range) != 2):
+        raise exceptions.InvalidArgumentsError("stretch_range must be [low, high]")
+
+
+def register_mosaic(app, driver_file, manifest_path):
+    """
+    Adds the /combine/{z}/{x}/{y}.png endpoint, which renders
+    a mosaic of every granule in keys_list. Optional parameters
+    are rgb_keys, channel, colormap and stretch_range
+    """
+    index = FootprintIndex(manifest_path)
+
+    @app.route("/combine/<int:z>/<int:x>/<int:y>.png")
+    def combine(z, x, y):
+        try:
+            granules = json.loads(request.args.get("keys_list", "[]"))
+            rgb_keys = json.loads(request.args.get("rgb_keys", "null"))
+            stretch_range = json.loads(request.args.get("stretch_range", "null"))
+        except ValueError:
+            return {"message": "keys_list, rgb_keys and stretch_range must be valid JSON"}, 400
+
+        colormap = request.args.get("colormap")
+        channel = request.args.get("channel", DEFAULT_CHANNEL)
+
+        # same statuses as terracotta's own endpoints
+        try:
+            _check_combine_args(granules, rgb_keys, stretch_range)
+            tile = render_mosaic(get_driver(driver_file), index, granules, (x, y, z), channel,
+                                 rgb_keys, colormap.lower() if colormap else None, stretch_range)
+        except exceptions.DatasetNotFoundError as e:
+            return {"message": str(e)}, 404
+        except (exceptions.InvalidArgumentsError, exceptions.InvalidKeyError) as e:
+            return {"message": str(e)}, 400
+
+        return send_file(tile, mimetype="image/png")
+
+    return app
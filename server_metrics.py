@@ -0,0 +1,107 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+
+from flask import Response, g, request
+
+from metrics import REGISTRY, REQUEST_SECONDS, REQUESTS, timed
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    # only cProfile is available
+    Profiler = None
+
+
+def instrument_terracotta():
+    """
+    Wraps the terracotta functions behind every tile request in
+    spans. GDAL reads the COG and reprojects it in one warped
+    read, which is often run in a process pool, so both are
+    timed together around get_tile_data. The rgb handler reads
+    asynchronously, its span ends once the read completes
+    """
+    from terracotta import image, xyz
+
+    # terracotta's own trace decorator already sets __wrapped__
+    if not hasattr(xyz.get_tile_data, "span_stage"):
+        xyz.get_tile_data = timed("cog_read_reproject", xyz.get_tile_data)
+
+    if not hasattr(image.array_to_png, "span_stage"):
+        image.array_to_png = timed("png_encode", image.array_to_png)
+
+
+def _profile_report(profiler, kind):
+    if kind == "pyinstrument":
+        profiler.stop()
+        return Response(profiler.output_html(), mimetype="text/html")
+
+    profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(50)
+
+    return Response(output.getvalue(), mimetype="text/plain")
+
+
+def install(app, snapshot_paths=None, profiling=False, profile_sample_rate=0.0, profile_dir=None):
+    """
+    Adds request latency and status metrics to a flask app, a
+    /metrics endpoint and, when profiling is set, a profiler
+    toggled per request with ?profile=cprofile or
+    ?profile=pyinstrument that answers with its report.
+    A profile_sample_rate fraction of all requests is also
+    profiled with cProfile and dumped to profile_dir
+    """
+    instrument_terracotta()
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        kind = request.args.get("profile") if profiling else None
+
+        if kind == None and profile_dir != None and random.random() < profile_sample_rate:
+            kind = "sampled"
+
+        if kind == "pyinstrument" and Profiler != None:
+            g.profiler = Profiler()
+            g.profiler.start()
+        elif kind in ["cprofile", "sampled"]:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+        g.profile_kind = kind
+
+    @app.after_request
+    def record_request_metrics(response):
+        # the route pattern keeps the label set bounded, requests
+        # matching no route (404s) share one label
+        endpoint = request.url_rule.rule if request.url_rule != None else "other"
+        start = g.get("request_start")
+
+        if start != None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+
+        REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+
+        profiler = g.pop("profiler", None)
+
+        if profiler == None:
+            return response
+
+        if g.profile_kind != "sampled":
+            return _profile_report(profiler, g.profile_kind)
+
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{request.endpoint or 'other'}-{time.time():.6f}-{os.getpid()}.prof"))
+
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(snapshot_paths), mimetype="text/plain; version=0.0.4")
+
+    return app
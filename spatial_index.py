@@ -0,0 +1,78 @@
+import math
+
+NODE_CAPACITY = 16
+
+
+def _union(boxes):
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+
+class STRTree:
+    """
+    Static R-tree bulk loaded with the Sort-Tile-Recursive
+    algorithm. Items are (west, south, east, north) boxes paired
+    with a value; query returns the values of every item whose
+    box intersects the query box, in insertion order
+    """
+
+    def __init__(self, items, node_capacity=NODE_CAPACITY):
+        self._node_capacity = node_capacity
+        self._size = len(items)
+
+        # entries are (box, (insertion order, value)) at level 0,
+        # every packing pass adds a level of (box, children) nodes
+        nodes = [(tuple(box), (i, value)) for i, (box, value) in enumerate(items)]
+        level = 0
+
+        while len(nodes) > node_capacity:
+            nodes = [(_union([box for box, _ in group]), group) for group in self._pack(nodes)]
+            level += 1
+
+        self._root = (_union([box for box, _ in nodes]), nodes) if len(nodes) > 0 else None
+        self._root_level = level + 1
+
+    def _pack(self, nodes):
+        # sort by x center into vertical slices, then each
+        # slice by y center into nodes of node_capacity entries
+        leaf_count = math.ceil(len(nodes) / self._node_capacity)
+        slice_count = math.ceil(math.sqrt(leaf_count))
+        slice_size = slice_count * self._node_capacity
+
+        nodes = sorted(nodes, key=lambda node: node[0][0] + node[0][2])
+        groups = []
+
+        for i in range(0, len(nodes), slice_size):
+            vertical_slice = sorted(nodes[i:i + slice_size], key=lambda node: node[0][1] + node[0][3])
+
+            for j in range(0, len(vertical_slice), self._node_capacity):
+                groups.append(vertical_slice[j:j + self._node_capacity])
+
+        return groups
+
+    def query(self, box):
+        if self._root == None:
+            return []
+
+        matches = []
+        stack = [(self._root, self._root_level)]
+
+        while len(stack) > 0:
+            (node_box, children), level = stack.pop()
+
+            if not _intersects(node_box, box):
+                continue
+
+            if level == 0:
+                matches.append(children)
+            else:
+                stack.extend((child, level - 1) for child in children)
+
+        return [value for _, value in sorted(matches, key=lambda match: match[0])]
+
+    def __len__(self):
+        return self._size
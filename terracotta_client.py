@@ -0,0 +1,128 @@
+from bisect import bisect_left
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import (TC_POOL_SIZE, TC_RETRIES, TC_RETRY_BACKOFF,
+                    TC_DEFAULT_TIMEOUT, TC_TIMEOUTS)
+
+# upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+
+class LatencyHistogram:
+    """
+    Thread safe histogram of request latencies
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._total = 0.0
+        self._count = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, milliseconds, error=False):
+        with self._lock:
+            self._counts[bisect_left(self._buckets, milliseconds)] += 1
+            self._total += milliseconds
+            self._count += 1
+            self._errors += int(error)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "buckets": {str(bound): count for bound, count in zip(self._buckets, self._counts)},
+                "count": self._count,
+                "errors": self._errors,
+                "mean_ms": self._total / self._count if self._count > 0 else 0
+            }
+
+
+class TerracottaClient:
+    """
+    HTTP client for a terracotta server. Keeps a pool of keep-alive
+    connections, applies a timeout per endpoint, retries failed
+    GETs with exponential backoff and records the latency of
+    every call per endpoint
+    """
+
+    def __init__(self, base_url, pool_size=TC_POOL_SIZE, retries=TC_RETRIES,
+                 backoff=TC_RETRY_BACKOFF, timeouts=TC_TIMEOUTS, default_timeout=TC_DEFAULT_TIMEOUT):
+        self._base_url = base_url.rstrip("/")
+        self._timeouts = timeouts
+        self._default_timeout = default_timeout
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def get(self, endpoint, *path, params=None):
+        """
+        Performs a GET against /endpoint/path... and returns
+        the decoded JSON response
+        """
+        url = "/".join([self._base_url, endpoint, *path])
+        timeout = self._timeouts.get(endpoint, self._default_timeout)
+        start = time.perf_counter()
+        error = True
+
+        try:
+            result = self._session.get(url, params=params, timeout=timeout)
+            result.raise_for_status()
+            error = False
+
+            return result.json()
+        finally:
+            self._histogram(endpoint).observe((time.perf_counter() - start) * 1000, error)
+
+    def datasets(self, **params):
+        return self.get("datasets", params=params)
+
+    def metadata(self, *keys):
+        return self.get("metadata", *keys)
+
+    def latency_stats(self):
+        with self._lock:
+            histograms = dict(self._latencies)
+
+        return {endpoint: histogram.snapshot() for endpoint, histogram in histograms.items()}
+
+    def _histogram(self, endpoint):
+        with self._lock:
+            if endpoint not in self._latencies:
+                self._latencies[endpoint] = LatencyHistogram()
+
+            return self._latencies[endpoint]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url):
+    """
+    Returns the process wide client for a terracotta server
+    """
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = TerracottaClient(base_url)
+
+        return _clients[base_url]
+
+
+def client_stats():
+    with _clients_lock:
+        clients = dict(_clients)
+
+    return {base_url: client.latency_stats() for base_url, client in clients.items()}
@@ -1,125 +1,469 @@
+import argparse
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Process
 
 import terracotta
-from terracotta.server import create_app
-from terracotta import update_settings
 from utils import extract_granule_metadata
-from geospatial_data.l1_to_tiff import l1_to_tiff, read_l1_data
-from config import TC_DEFAULT_PORT
+from geospatial_data.ingest import BANDS_FILE, convert_granule
+from geospatial_data.manifest import IngestManifest, MANIFEST_NAME
+from geospatial_data.quantization import check_storage
+from geospatial_data.resamplers import NeighbourCache
+from geospatial_data.watcher import GranuleWatcher
+from tile_warmer import granule_tile_urls, warm_tiles
+from tile_server import create_server_app, run_server
+from config import DB_NAME, DB_PATH, INGEST_METRICS_NAME, TC_DEFAULT_PORT, TC_HOST
+import metrics
 
 CHANNEL_INDEXES = {
     "red": 40, "green": 4,
     "blue": 84, "infrared": 74
 }
 AH2_PARAMS = ["campaign", "instrument", "date", "level", "channel"]
-DB_NAME = "tc_db.sqlite"
-DB_PATH = "geospatial_data/database"
 SAMPLES_PATH = "geospatial_data/granules"
-HOST = "localhost"
-PORT = TC_DEFAULT_PORT
 ANGLE_INDEX = 40
-
-# apply global settings update
-# to terracotta
-update_settings(DRIVER_PATH=os.path.join(DB_PATH, DB_NAME), REPROJECTION_METHOD="nearest")
+RESAMPLE_RADIUS = 300
+INGEST_WORKERS = os.cpu_count() or 1
+# threads converting the channels of one granule at once when
+# a granule is served on its own, 1 converts them in turn
+CHANNEL_WORKERS = min(len(CHANNEL_INDEXES), INGEST_WORKERS)
+# COG creation options, higher compression trades ingest CPU
+# for smaller files, smaller blocks favour tile-serving latency
+COG_COMPRESSION = "deflate"
+COG_BLOCKSIZE = 512
+# stored pixel type: "float32" or "uint16" with a scale and
+# offset per band, the tile server converts back to radiance
+COG_STORAGE = "float32"
+WATCH_GRANULES = True
+WATCH_POLL_INTERVAL = 5.0
+# pre-render tiles of newly ingested granules
+WARM_TILES = False
+WARM_WORKERS = 4
+RGB_CHANNELS = ["red", "green", "blue"]
+# further bands exported next to CHANNEL_INDEXES, as keyword
+# arguments of geospatial_data.bands.select_bands, e.g.
+# {"quantities": ["i", "dolp"], "views": [4, 40, 74, 84]}
+EXTRA_BANDS = None
+# memory ceiling per conversion, when set granules are read
+# lazily and resampled in row blocks instead of all at once.
+# Reading the geolocation and building the neighbour search
+# once per granule are not bounded by it, see stream_l1_to_tiffs
+CONVERSION_MEMORY_BYTES = None
+# neighbour search used for in-memory resampling, "pyresample" or
+# "scipy" (multi-threaded). The row block mode above always uses
+# scipy, whose tree is kept between blocks
+RESAMPLE_BACKEND = "pyresample"
+# neighbour indexes kept per swath geometry, so reconverting a
+# granule with other channels or options skips the search
+NEIGHBOUR_CACHE_DIR = "neighbour_cache"
+# indexes unused for this many seconds are evicted, then the least
+# recently used ones until the cache fits NEIGHBOUR_CACHE_BYTES
+NEIGHBOUR_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+NEIGHBOUR_CACHE_BYTES = 8 * 2**30
 
 
 class PACEHARP2TCServer:
-    def __init__(self, driver_path, nuke=True):
+    def __init__(self, driver_path, nuke=True, warm_tiles=WARM_TILES):
         if not driver_path:
             raise Exception("paceharp2tcserver: No driver path has been specified.")
 
+        # fail before touching the database rather than per granule
+        check_storage(COG_STORAGE)
+
         os.makedirs(driver_path, exist_ok=True)
         database_file = os.path.join(driver_path, DB_NAME)
-        if nuke and os.path.isfile(database_file):
-            os.remove(database_file)
+        manifest_file = os.path.join(driver_path, MANIFEST_NAME)
+        if nuke:
+            for file in [database_file, manifest_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
 
         self._driver_path = driver_path
+        self._warm_tiles = warm_tiles
         self._files = []
+        self._dataset_keys = None
+        self._manifest = IngestManifest(manifest_file)
         self._driver = terracotta.get_driver(database_file)
-        self._server = create_app()
+        self._neighbour_cache = NeighbourCache(os.path.join(driver_path, NEIGHBOUR_CACHE_DIR),
+                                               NEIGHBOUR_CACHE_BYTES, NEIGHBOUR_CACHE_MAX_AGE)
 
         if not os.path.isfile(database_file):
             self._driver.create(keys=AH2_PARAMS)
 
-    def run(self, port, host):
-        self._server.run(port=port, host=host, threaded=False)
-
-    def load_from_directory(self, data_path):
+    def load_from_directory(self, data_path, workers=1):
         if not os.path.isdir(data_path):
-            raise Exception("")
+            raise Exception(f"PACEHARP2TCServer.load_from_directory: '{data_path}' is not a directory.")
 
         entries = []
+        self._build_dataset_index()
+        params = self._manifest_params()
 
         # now we need to filter through the data path
         # and collect all netCDF files to convert and insert.
-        # avoid rentry of already present data
+        # avoid rentry of granules that are unchanged since
+        # they were last converted with the current parameters
         for entry in os.listdir(data_path):
             if entry.split(".")[-1] == "nc":
                 basename = os.path.basename(entry)
                 metadata = extract_granule_metadata(basename)
+                path = os.path.join(data_path, entry)
 
-                if not self.dataset_exists(metadata):
+                if not self.dataset_exists(metadata) or not self._manifest.is_current(path, params):
                     entries.append(entry)
                 else:
                     print(f"PACEHARP2TCServer.serve_granule: skipping {basename} since it already exists")
-        
+
+        self._remove_stale_granules()
+
         if len(entries) > 0:
-            print(f"PACEHARP2TCServer.load_from_directory: loading {len(entries)} files from {data_path}")
+            print(f"PACEHARP2TCServer.load_from_directory: loading {len(entries)} files from {data_path} using {workers} worker(s)")
+            paths = [os.path.join(data_path, entry) for entry in entries]
+
+            if workers > 1:
+                inserted = self._load_parallel(paths, workers)
+            else:
+                inserted = []
+
+                # like the parallel path, a failed granule is
+                # reported and the others are still ingested
+                for i in range(len(paths)):
+                    print(f"PACEHARP2TCServer.load_from_directory: file {i} of {len(paths)}")
+
+                    try:
+                        inserted.append(self.serve_granule(paths[i], warm=False))
+                    except Exception as e:
+                        print(f"PACEHARP2TCServer.load_from_directory: failed to ingest {os.path.basename(paths[i])}: {e}")
+
+            # every granule was committed as it was inserted
+            if self._warm_tiles:
+                self.warm_granules(inserted)
+
+    def _load_parallel(self, paths, workers):
+        """
+        Converts granules across a pool of worker processes while
+        this process acts as the single writer, so the SQLite
+        database is never written concurrently. Each granule is
+        committed on its own before its manifest entry is saved
+        """
+        stage_totals = {}
+        inserted = []
+        completed = 0
+        failed = 0
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(convert_granule, path, self._driver_path, **self._conversion_options()): path
+                for path in paths
+            }
+
+            for future in as_completed(futures):
+                path = futures[future]
+
+                try:
+                    l1_meta, outputs, statistics, timings = future.result()
+
+                    with metrics.collect_spans() as insert_timings:
+                        self._insert_granule(l1_meta, outputs, path, statistics)
+                except Exception as e:
+                    failed += 1
+                    print(f"PACEHARP2TCServer.load_from_directory: failed to ingest {os.path.basename(path)}: {e}")
+                    continue
+
+                # conversion spans were collected in the worker process
+                self._record_stages({**timings, **insert_timings})
+                inserted.append(l1_meta)
+
+                for stage, seconds in {**timings, **insert_timings}.items():
+                    stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+
+                completed += 1
+                elapsed = time.perf_counter() - start
+                print(f"PACEHARP2TCServer.load_from_directory: file {completed + failed} of {len(paths)} "
+                      f"({os.path.basename(path)}, {completed / elapsed:.2f} granules/s)")
 
-            with self._driver.connect():
-                for i in range(len(entries)):
-                    print(f"PACEHARP2TCServer.load_from_directory: file {i} of {len(entries)}")
-                    entry = entries[i]
-                    path = os.path.join(data_path, entry)
-                    tc_server.serve_granule(path)
+        elapsed = time.perf_counter() - start
+        stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_totals.items())
+        print(f"PACEHARP2TCServer.load_from_directory: converted {completed} of {len(paths)} files "
+              f"in {elapsed:.1f}s ({failed} failed); cumulative stage time: {stages}")
+
+        return inserted
+
+    def _build_dataset_index(self):
+        """
+        Caches the (campaign, instrument, date, level) key of every
+        inserted dataset so existence checks avoid a metadata query
+        """
+        self._dataset_keys = {tuple(key[:4]) for key in self._driver.get_datasets()}
+
+    def _granule_key(self, metadata):
+        return (metadata["campaign"], metadata["instrument"], metadata["date"], metadata["level"])
 
     def dataset_exists(self, metadata):
-        datasets = self._driver.get_datasets()
+        if self._dataset_keys is None:
+            self._build_dataset_index()
 
-        for key in datasets:
-            if  (key[0] == metadata["campaign"] and key[1] == metadata["instrument"] and
-                 key[2] == metadata["date"] and key[3] == metadata["level"]):
-                return True
-        
-        return False
+        return self._granule_key(metadata) in self._dataset_keys
 
-    def serve_granule(self, nc_path):
-        filename = os.path.basename(nc_path)
+    def _conversion_options(self):
+        return {
+            "channel_indexes": CHANNEL_INDEXES,
+            "max_radius": RESAMPLE_RADIUS,
+            "compress": COG_COMPRESSION,
+            "blocksize": COG_BLOCKSIZE,
+            "storage": COG_STORAGE,
+            "band_selection": EXTRA_BANDS,
+            "max_memory_bytes": CONVERSION_MEMORY_BYTES,
+            "backend": RESAMPLE_BACKEND,
+            "neighbour_cache_dir": os.path.join(self._driver_path, NEIGHBOUR_CACHE_DIR)
+        }
 
-        # convert netCDF -> GeoTIFF
-        prefix, _ = os.path.splitext(filename)
-        os.makedirs(os.path.join(self._driver_path, prefix), exist_ok=True)
+    def _manifest_params(self):
+        # everything that changes the produced rasters, a mismatch
+        # with the manifest means the granule must be reconverted
+        params = {**self._conversion_options(), "angle_index": ANGLE_INDEX}
+        # the ceiling only changes how a granule is converted,
+        # switching conversion modes still reconverts it
+        params["streaming"] = params.pop("max_memory_bytes") != None
+        params.pop("neighbour_cache_dir")
+
+        return params
 
-        # TODO: change l1c constant to be based upon file name
-        #       once we are sure file naming is consistent
-        l1_data = read_l1_data(nc_path, "l1c")
-        l1_meta = extract_granule_metadata(filename)
+    def _remove_stale_granules(self):
+        """
+        Drops datasets whose source granule has been removed
+        since it was ingested
+        """
+        stale = [entry for entry in self._manifest.entries().values()
+                 if not os.path.isfile(entry["source"])]
 
-        if l1_meta == None:
-            raise Exception(f"PACEHARP2TCServer.serve_granule: File '{filename}' has an unexpected naming convention.")
+        if len(stale) == 0:
+            return
 
-        channels = CHANNEL_INDEXES.keys()
+        with self._driver.connect():
+            for entry in stale:
+                print(f"PACEHARP2TCServer.load_from_directory: removing {os.path.basename(entry['source'])} since its source is gone")
+                self._delete_outputs(entry["keys"], entry["outputs"])
+                self._manifest.remove(entry["source"])
 
-        for channel in channels:
-            tiff_path = os.path.join(self._driver_path, prefix, f"{channel}-channel.tif")
-            l1_to_tiff(l1_data, tiff_path, CHANNEL_INDEXES[channel])
+                if self._dataset_keys is not None:
+                    self._dataset_keys.discard(self._granule_key(entry["keys"]))
 
-            # optimize by converting to COG
-            os.system(f"terracotta optimize-rasters --overwrite -q {tiff_path} -o {os.path.join(self._driver_path, prefix)}")
+        self._manifest.save()
+        self._neighbour_cache.remove_sources([entry["source"] for entry in stale])
 
+    def _delete_outputs(self, l1_meta, outputs):
+        granule_dirs = set()
+
+        for channel, tiff_path in outputs.items():
             metadata = l1_meta.copy()
             metadata["channel"] = channel
 
-            # place into tc driver
-            self._driver.insert(metadata, tiff_path)
+            try:
+                self._driver.delete(metadata)
+            except Exception as e:
+                print(f"PACEHARP2TCServer._delete_outputs: could not delete {channel} dataset: {e}")
+
+            if os.path.isfile(tiff_path):
+                os.remove(tiff_path)
+
+            granule_dirs.add(os.path.dirname(tiff_path))
+
+        for granule_dir in granule_dirs:
+            _remove_unused_files(granule_dir)
+
+    def watch_directory(self, data_path, poll_interval=WATCH_POLL_INTERVAL):
+        """
+        Starts ingesting granules as they arrive in data_path on a
+        background thread. Returns the running GranuleWatcher
+        """
+        watcher = GranuleWatcher(data_path, self._ingest_arrival, poll_interval)
+        watcher.start()
+
+        return watcher
+
+    def _ingest_arrival(self, nc_path):
+        basename = os.path.basename(nc_path)
+        metadata = extract_granule_metadata(basename)
+
+        if metadata == None:
+            print(f"PACEHARP2TCServer.watch_directory: ignoring {basename} due to an unexpected naming convention")
+            return
+
+        if self.dataset_exists(metadata) and self._manifest.is_current(nc_path, self._manifest_params()):
+            return
+
+        print(f"PACEHARP2TCServer.watch_directory: ingesting {basename}")
+        start = time.perf_counter()
+
+        self.serve_granule(nc_path)
+        print(f"PACEHARP2TCServer.watch_directory: {basename} is now available ({time.perf_counter() - start:.1f}s)")
+
+    def serve_granule(self, nc_path, warm=None, channel_workers=CHANNEL_WORKERS):
+        """
+        Converts and inserts a single granule, then optionally
+        pre-renders its tiles. Its channels are converted on up
+        to channel_workers threads while the inserts stay on
+        this one. Returns the granule metadata
+        """
+        # convert netCDF -> GeoTIFF
+        l1_meta, outputs, statistics, timings = convert_granule(nc_path, self._driver_path, workers=channel_workers,
+                                                                **self._conversion_options())
+
+        with metrics.collect_spans() as insert_timings:
+            self._insert_granule(l1_meta, outputs, nc_path, statistics)
+
+        self._record_stages({**timings, **insert_timings})
+
+        if warm if warm != None else self._warm_tiles:
+            self.warm_granules([l1_meta])
+
+        return l1_meta
+
+    def warm_granules(self, granules):
+        """
+        Renders and caches the tiles the map shows for each of the
+        given granules on its own, every channel and the rgb
+        composite with the default colormap and stretch, at the
+        zoom levels around the default map viewport
+        """
+        urls = []
+
+        for l1_meta in granules:
+            metadatas = {channel: self._driver.get_metadata({**l1_meta, "channel": channel})
+                         for channel in CHANNEL_INDEXES}
+            convex_hull = metadatas[RGB_CHANNELS[0]]["convex_hull"]
+
+            urls += granule_tile_urls(l1_meta, CHANNEL_INDEXES.keys(), RGB_CHANNELS, convex_hull, metadatas)
+
+        start = time.perf_counter()
+        rendered = warm_tiles(urls, create_server_app, self._driver_path, WARM_WORKERS)
+        print(f"PACEHARP2TCServer.warm_granules: rendered {rendered} of {len(urls)} tiles "
+              f"for {len(granules)} granule(s) in {time.perf_counter() - start:.1f}s")
+
+    def _insert_granule(self, l1_meta, outputs, nc_path, statistics=None):
+        """
+        Inserts the converted channels of a granule in their own
+        connection, and records the granule in the manifest only
+        once they are committed
+        """
+        previous = self._manifest.get(nc_path)
+
+        with self._driver.connect():
+            if previous != None:
+                # channels that are no longer exported
+                channels = {channel for channel, _ in outputs}
+                dropped = {channel: path for channel, path in previous["outputs"].items()
+                           if channel not in channels}
+                self._delete_outputs(previous["keys"], dropped)
+
+            with metrics.span("insert"):
+                for channel, tiff_path in outputs:
+                    metadata = l1_meta.copy()
+                    metadata["channel"] = channel
+
+                    # place into tc driver, with the metadata computed
+                    # by the conversion so the writer skips reading the raster
+                    self._driver.insert(metadata, tiff_path, metadata=(statistics or {}).get(tiff_path))
+
+            # footprint used by the mosaic endpoint's spatial index
+            metadata = l1_meta.copy()
+            metadata["channel"] = outputs[0][0]
+            dataset = self._driver.get_metadata(metadata)
+            footprint = {"bounds": dataset["bounds"], "convex_hull": dataset["convex_hull"]}
+
+        if self._dataset_keys is not None:
+            self._dataset_keys.add(self._granule_key(l1_meta))
+
+        keys = {key: l1_meta[key] for key in AH2_PARAMS if key != "channel"}
+        self._manifest.record(nc_path, keys, self._manifest_params(), outputs, footprint)
+        self._manifest.save()
+        # every conversion may have added a neighbour index
+        self._neighbour_cache.prune()
+
+    def _record_stages(self, timings):
+        """
+        Observes the stage totals of one granule and dumps the
+        metrics for the tile server's /metrics
+        """
+        metrics.observe_stages(timings)
+        metrics.REGISTRY.dump(os.path.join(self._driver_path, INGEST_METRICS_NAME))
+
+
+def _remove_unused_files(granule_dir):
+    """
+    Deletes the multi-band raster of a granule once no band VRT
+    refers to it anymore, and the granule directory once empty
+    """
+    if not os.path.isdir(granule_dir):
+        return
+
+    entries = os.listdir(granule_dir)
+
+    if BANDS_FILE in entries and not any(entry.endswith(".vrt") for entry in entries):
+        os.remove(os.path.join(granule_dir, BANDS_FILE))
+
+    if len(os.listdir(granule_dir)) == 0:
+        os.rmdir(granule_dir)
+
+
+def watch_granules(driver_path, data_path):
+    """
+    Runs the watch-folder ingestion service until the process
+    exits. Meant to live in its own process so the tile server
+    never shares a driver connection with the ingest thread
+    """
+    server = PACEHARP2TCServer(driver_path, False)
+    server.watch_directory(data_path).join()
+
+
+def ingest(driver_path, data_path, workers=INGEST_WORKERS, nuke=False, watch=False, warm=WARM_TILES):
+    """
+    Ingestion entry point, converts and inserts every new or
+    changed granule in data_path and optionally keeps watching
+    it for new arrivals
+    """
+    server = PACEHARP2TCServer(driver_path, nuke, warm)
+    server.load_from_directory(data_path, workers=workers)
+
+    if watch:
+        server.watch_directory(data_path).join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PACE HARP2 terracotta tile server")
+    parser.add_argument("--db-path", default=DB_PATH, help="directory holding the terracotta database")
+    commands = parser.add_subparsers(dest="command")
+
+    ingest_parser = commands.add_parser("ingest", help="convert and insert granules into the database")
+    ingest_parser.add_argument("--data-path", default=SAMPLES_PATH, help="directory of L1 netCDF granules")
+    ingest_parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="conversion worker processes")
+    ingest_parser.add_argument("--nuke", action="store_true", help="delete the database before ingesting")
+    ingest_parser.add_argument("--watch", action="store_true", help="keep ingesting granules as they arrive")
+    ingest_parser.add_argument("--warm", action="store_true", default=WARM_TILES,
+                               help="pre-render tiles of newly ingested granules")
+
+    serve_parser = commands.add_parser("serve", help="serve tiles from an existing database")
+    serve_parser.add_argument("--port", type=int, default=TC_DEFAULT_PORT)
+    serve_parser.add_argument("--host", default=TC_HOST)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        ingest(args.db_path, args.data_path, args.workers, args.nuke, args.watch, args.warm)
+    elif args.command == "serve":
+        run_server(args.port, args.host, args.db_path)
+    else:
+        # development default: ingest once, then serve while
+        # a separate process picks up newly arriving granules
+        ingest(args.db_path, SAMPLES_PATH)
 
+        if WATCH_GRANULES:
+            Process(target=watch_granules, args=(args.db_path, SAMPLES_PATH), daemon=True).start()
 
-tc_server = PACEHARP2TCServer(DB_PATH, False)
-tc_server.load_from_directory(SAMPLES_PATH)
+        run_server(TC_DEFAULT_PORT, TC_HOST, args.db_path)
 
-# expose flask instance for guincorn
-app = tc_server._server
 
 if __name__ == "__main__":
-    tc_server.run(PORT, HOST)
+    main()
@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from urllib.parse import unquote
+import hashlib
+import json
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+CACHED_ENDPOINTS = ["singleband", "rgb", "combine"]
+# query parameters holding JSON, re-encoded so formatting
+# differences do not produce separate cache entries
+JSON_PARAMS = ["keys_list", "rgb_keys", "stretch_range"]
+# seconds between rescans of the disk tier, which picks up the
+# tiles other workers wrote or evicted since the last scan
+DISK_RESCAN_INTERVAL = 60.0
+
+
+def referenced_granules(path, args):
+    """
+    Returns the "campaign/instrument/date/level" granule keys a
+    tile request reads from
+    """
+    parts = [unquote(part) for part in path.strip("/").split("/")]
+
+    if parts[0] in ["singleband", "rgb"]:
+        return ["/".join(parts[1:5])]
+
+    if parts[0] == "combine":
+        try:
+            return list(json.loads(args.get("keys_list", "[]")))
+        except ValueError:
+            return []
+
+    return []
+
+
+def normalize_request(path, args):
+    """
+    Canonical representation of a tile request: the endpoint path
+    plus every query parameter in sorted order, with JSON values
+    and colormap names normalized
+    """
+    params = []
+
+    for name in sorted(args.keys()):
+        value = args.get(name)
+
+        if name in JSON_PARAMS:
+            try:
+                # browsers print integral floats without a fraction
+                value = json.dumps(json.loads(value, parse_int=float), separators=(",", ":"))
+            except ValueError:
+                pass
+        elif name == "colormap":
+            value = value.lower()
+
+        params.append(f"{name}={value}")
+
+    return f"{path.rstrip('/')}?{'&'.join(params)}"
+
+
+class TileCache:
+    """
+    Two tier LRU cache of rendered tiles. Recently used tiles live
+    in memory, everything else on disk where it is shared between
+    server workers (and with ingestion warm-up). Both tiers evict
+    least recently used tiles once their byte budget is exceeded.
+    The disk budget is enforced on the directory itself: the index
+    is rebuilt from the files every rescan_interval seconds and
+    tiles are evicted by oldest modification time, which reads
+    refresh, so every worker evicts the same tiles.
+
+    Cache keys include the ingestion version of every granule a
+    tile reads, so re-inserting a granule makes its old tiles
+    unreachable without coordinating between processes
+    """
+
+    def __init__(self, cache_dir=None, max_memory_bytes=256 * 2**20,
+                 max_disk_bytes=4 * 2**30, version_lookup=None, rescan_interval=DISK_RESCAN_INTERVAL):
+        self._cache_dir = cache_dir
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+        self._version_lookup = version_lookup or (lambda granule: 0)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = None
+        self._disk_bytes = 0
+        self._rescan_interval = rescan_interval
+        self._scanned = 0.0
+        # tiles written since the current scan started, which
+        # it may have missed
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def key(self, path, args):
+        granules = referenced_granules(path, args)
+        versions = ",".join(f"{granule}@{self._version_lookup(granule)}" for granule in granules)
+        request_key = f"{normalize_request(path, args)}#{versions}"
+
+        return hashlib.sha1(request_key.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+
+            if data != None:
+                self._memory.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return data
+
+        data = self._read_disk(key)
+
+        with self._lock:
+            if data == None:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            self._stats["disk_hits"] += 1
+            self._put_memory(key, data)
+
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._put_memory(key, data)
+
+        self._write_disk(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+
+            return {
+                **self._stats,
+                "hit_ratio": self._stats["hits"] / lookups if lookups > 0 else 0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk) if self._disk != None else 0,
+                "disk_bytes": self._disk_bytes
+            }
+
+    def _put_memory(self, key, data):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+
+        while self._memory_bytes > self._max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self._cache_dir, key[:2], f"{key}.png")
+
+    def _load_disk_index(self):
+        # scanned lazily on first use, oldest tiles first, so
+        # constructing the cache never touches the disk. Rescanned
+        # periodically since the other workers share the directory.
+        # The scan runs without the lock, lookups keep using the
+        # current index until the new one is swapped in
+        with self._lock:
+            if self._disk != None and time.monotonic() - self._scanned < self._rescan_interval:
+                return
+
+            self._scanned = time.monotonic()
+            self._written = OrderedDict()
+
+        entries = []
+
+        if os.path.isdir(self._cache_dir):
+            for root, _, files in os.walk(self._cache_dir):
+                for file in files:
+                    if not file.endswith(".png"):
+                        continue
+
+                    try:
+                        stat = os.stat(os.path.join(root, file))
+                    except FileNotFoundError:
+                        # evicted by another worker meanwhile
+                        continue
+
+                    entries.append((stat.st_mtime, file[:-len(".png")], stat.st_size))
+
+        entries.sort()
+        disk = OrderedDict((key, size) for _, key, size in entries)
+
+        with self._lock:
+            disk.update(self._written)
+
+            for key in self._written:
+                disk.move_to_end(key)
+
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+
+    def _read_disk(self, key):
+        if self._cache_dir == None:
+            return None
+
+        path = self._disk_path(key)
+
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            # the modification time orders evictions in every worker
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self._load_disk_index()
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+
+        return data
+
+    def _write_disk(self, key, data):
+        if self._cache_dir == None:
+            return
+
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # other workers may read the tile while it is written
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(temp_path, "wb") as file:
+            file.write(data)
+
+        os.replace(temp_path, path)
+
+        evicted = []
+        self._load_disk_index()
+
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._written[key] = len(data)
+
+            while self._disk_bytes > self._max_disk_bytes and len(self._disk) > 1:
+                evicted_key, size = self._disk.popitem(last=False)
+                self._written.pop(evicted_key, None)
+                self._disk_bytes -= size
+                self._stats["evictions"] += 1
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self._disk_path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def install(self, app):
+        """
+        Serves cached tiles ahead of the terracotta handlers and
+        stores freshly rendered ones. Adds an X-Tile-Cache header
+        and a /cache/stats endpoint
+        """
+        @app.before_request
+        def serve_cached_tile():
+            endpoint = request.path.strip("/").split("/")[0]
+
+            if endpoint not in CACHED_ENDPOINTS or not request.path.endswith(".png"):
+                return None
+
+            g.tile_cache_key = self.key(request.path, request.args)
+            data = self.get(g.tile_cache_key)
+
+            if data == None:
+                return None
+
+            response = Response(data, mimetype="image/png")
+            response.headers["X-Tile-Cache"] = "HIT"
+            g.tile_cache_key = None
+
+            return response
+
+        @app.after_request
+        def store_rendered_tile(response):
+            key = g.get("tile_cache_key")
+
+            if key != None and response.status_code == 200:
+                # terracotta streams tiles through send_file
+                response.direct_passthrough = False
+                self.put(key, response.get_data())
+                response.headers["X-Tile-Cache"] = "MISS"
+
+            return response
+
+        @app.route("/cache/stats")
+        def tile_cache_stats():
+            return self.stats()
+
+        return app
@@ -0,0 +1,76 @@
+import os
+
+from terracotta import update_settings
+from terracotta.server import create_app
+
+import server_metrics
+from config import DB_NAME, DB_PATH, INGEST_METRICS_NAME, TC_DEFAULT_PORT, TC_HOST
+from geospatial_data.manifest import IngestManifest, MANIFEST_NAME
+from geospatial_data.quantization import install_tile_scaling
+from mosaic import register_mosaic
+from tile_cache import TileCache
+
+TILE_CACHE_DIR = "tile_cache"
+TILE_CACHE_MEMORY_BYTES = 256 * 2**20
+TILE_CACHE_DISK_BYTES = 4 * 2**30
+# answer ?profile=cprofile (or pyinstrument) with a profile report
+PROFILE_REQUESTS = False
+# fraction of requests profiled in the background
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR = "profiles"
+
+
+def create_server_app(driver_path=DB_PATH):
+    """
+    Serve-only app factory. Points terracotta at an existing
+    database and returns the flask app without scanning,
+    converting or writing anything, so workers boot instantly.
+    Populate the database with the ingest subcommand of
+    terracotta_server.py, this module never imports the
+    conversion stack. Run it with
+    gunicorn "tile_server:create_server_app()", importing this
+    module builds no app
+    """
+    # apply global settings update
+    # to terracotta
+    update_settings(DRIVER_PATH=os.path.join(driver_path, DB_NAME), REPROJECTION_METHOD="nearest")
+
+    server = create_app()
+    # tiles of quantized rasters are read back as radiance
+    install_tile_scaling()
+    # installed first so request timings include cache lookups
+    server_metrics.install(server, {"ingest": os.path.join(driver_path, INGEST_METRICS_NAME)},
+                           PROFILE_REQUESTS, PROFILE_SAMPLE_RATE, os.path.join(driver_path, PROFILE_DIR))
+    register_mosaic(server, os.path.join(driver_path, DB_NAME), os.path.join(driver_path, MANIFEST_NAME))
+    create_tile_cache(driver_path).install(server)
+
+    return server
+
+
+def create_tile_cache(driver_path=DB_PATH):
+    """
+    Creates the tile cache shared by the server workers. Tiles
+    are versioned by the ingestion time recorded in the manifest,
+    which is only read once the first tile is requested
+    """
+    manifest_file = os.path.join(driver_path, MANIFEST_NAME)
+    manifest = None
+    versions = {}
+
+    def granule_version(granule):
+        nonlocal manifest, versions
+
+        if manifest == None:
+            manifest = IngestManifest(manifest_file)
+            versions = manifest.granule_versions()
+        elif manifest.reload():
+            versions = manifest.granule_versions()
+
+        return versions.get(granule, 0)
+
+    return TileCache(os.path.join(driver_path, TILE_CACHE_DIR), TILE_CACHE_MEMORY_BYTES,
+                     TILE_CACHE_DISK_BYTES, granule_version)
+
+
+def run_server(port=TC_DEFAULT_PORT, host=TC_HOST, driver_path=DB_PATH):
+    create_server_app(driver_path).run(port=port, host=host, threaded=False)
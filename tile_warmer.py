@@ -0,0 +1,88 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from terracotta import update_settings
+
+from config import STRETCH_PERCENTILES
+from utils import combine_url, percentile_stretch, tiles_for_hull
+
+WARM_ZOOMS = [9, 10, 11]
+MAX_TILES_PER_ZOOM = 256
+# default of the map's colormap dropdown, as the browser sends it
+WARM_COLORMAP = "viridis"
+
+# flask app of the current warm-up worker process
+_worker_app = None
+
+
+def granule_tile_urls(granule_keys, channels, rgb_channels, convex_hull, metadatas,
+                      zooms=WARM_ZOOMS, colormap=WARM_COLORMAP):
+    """
+    Returns the combine tile paths the map requests when a single
+    granule is shown, for every channel and the rgb composite,
+    covering its convex hull at each zoom. metadatas maps channels
+    to their terracotta metadata, which gives the default stretch
+    """
+    granule = "/".join(granule_keys[key] for key in ["campaign", "instrument", "date", "level"])
+    templates = []
+
+    for channel in channels:
+        stretch = percentile_stretch([metadatas[channel]], STRETCH_PERCENTILES)
+        templates.append(combine_url("/", [granule], None, channel, colormap, stretch))
+
+    # the map renders the composite with the first rgb channel
+    # selected and one stretch shared by the three channels
+    stretch = percentile_stretch([metadatas[channel] for channel in rgb_channels], STRETCH_PERCENTILES)
+    templates.append(combine_url("/", [granule], list(rgb_channels), rgb_channels[0], colormap, stretch))
+
+    urls = []
+
+    for zoom in zooms:
+        tiles = tiles_for_hull(convex_hull, zoom)
+
+        if len(tiles) > MAX_TILES_PER_ZOOM:
+            print(f"granule_tile_urls: skipping zoom {zoom} with {len(tiles)} tiles")
+            continue
+
+        for x, y in tiles:
+            # the query strings are url encoded, so the only
+            # braces left are the tile placeholders
+            urls += [template.format(z=zoom, x=x, y=y) for template in templates]
+
+    return urls
+
+
+def _init_worker(app_factory, driver_path):
+    global _worker_app
+    _worker_app = app_factory(driver_path)
+    # the pool already reads in parallel, a process pool of
+    # terracotta's own per worker keeps the workers from exiting
+    update_settings(USE_MULTIPROCESSING=False)
+
+
+def _render_tiles(urls):
+    client = _worker_app.test_client()
+    rendered = 0
+
+    for url in urls:
+        # rendering goes through the tile cache hooks,
+        # which persist every tile to the shared disk tier
+        if client.get(url).status_code == 200:
+            rendered += 1
+
+    return rendered
+
+
+def warm_tiles(urls, app_factory, driver_path, workers=4):
+    """
+    Renders tile urls across a pool of processes, each with its
+    own server app so no driver connection is shared.
+    Returns the number of tiles rendered successfully
+    """
+    if len(urls) == 0:
+        return 0
+
+    batches = [urls[i::workers] for i in range(workers)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(app_factory, driver_path)) as pool:
+        return sum(pool.map(_render_tiles, batches))
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
 from terracotta_toolbelt import urljoin
+import numpy as np
 import urllib.parse
 import binascii
 import json
+import math
 import os
 import re
 
@@ -12,25 +14,16 @@ def get_date_range(available):
     that do not have data between the oldest and latest
     date in the list
     """
-    min = available[0]
-    max = available[0]
-    unavailable = []
+    stamps = np.array(available, dtype="datetime64[us]")
+    min = available[stamps.argmin()]
+    max = available[stamps.argmax()]
 
-    for day in available:
-        if day < min:
-            min = day
-        if day > max:
-            max = day
+    days = np.unique(stamps.astype("datetime64[D]"))
+    day_range = np.arange(days[0], days[-1] + np.timedelta64(1, "D"))
+    offsets = (np.setdiff1d(day_range, days, assume_unique=True) - days[0]).astype(int)
 
-    current = min
-
-    while current < max:
-        available_dates = [dt.date() for dt in available]
-
-        if current.date() not in available_dates:
-            unavailable.append(current)
-        
-        current += timedelta(days=1)
+    # missing days keep the time of day of the oldest entry
+    unavailable = [min + timedelta(days=int(offset)) for offset in offsets]
 
     return min, max, unavailable
 
@@ -75,17 +68,86 @@ def get_average_of_coordinates(points):
     Returns a point that represents the average
     of all the listed points
     """
-    
-    x_sum = 0
-    y_sum = 0
+    return np.asarray(points, dtype=float)[:, :2].mean(axis=0).tolist()
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+    Returns the web mercator x, y tile containing a point
+    """
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
 
-    for point in points:
-        x_sum += point[0]
-        y_sum += point[1]
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
 
-    total_points = len(points)
-    
-    return [x_sum / total_points, y_sum / total_points]
+def tile_bounds(x, y, zoom):
+    """
+    Returns the (west, south, east, north) bounds of a tile
+    """
+    n = 2 ** zoom
+
+    def tile_lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return x / n * 360.0 - 180.0, tile_lat(y + 1), (x + 1) / n * 360.0 - 180.0, tile_lat(y)
+
+def hull_polygon(convex_hull):
+    """
+    Returns the vertices of a GeoJSON convex hull polygon
+    without the repeated closing vertex
+    """
+    polygon = [tuple(point) for point in convex_hull["coordinates"][0]]
+
+    if len(polygon) > 1 and polygon[0] == polygon[-1]:
+        polygon = polygon[:-1]
+
+    return polygon
+
+def polygon_intersects_box(polygon, west, south, east, north):
+    """
+    Returns true if a convex polygon overlaps a lon/lat box,
+    using the separating axis test
+    """
+    box = [(west, south), (east, south), (east, north), (west, north)]
+    xs = [point[0] for point in polygon]
+    ys = [point[1] for point in polygon]
+
+    if max(xs) < west or min(xs) > east or max(ys) < south or min(ys) > north:
+        return False
+
+    for i in range(len(polygon)):
+        x1, y1 = polygon[i]
+        x2, y2 = polygon[(i + 1) % len(polygon)]
+        normal = (y2 - y1, x1 - x2)
+
+        polygon_proj = [normal[0] * px + normal[1] * py for px, py in polygon]
+        box_proj = [normal[0] * bx + normal[1] * by for bx, by in box]
+
+        if max(box_proj) < min(polygon_proj) or min(box_proj) > max(polygon_proj):
+            return False
+
+    return True
+
+def tiles_for_hull(convex_hull, zoom):
+    """
+    Returns every (x, y) tile at a zoom level that intersects
+    a GeoJSON convex hull polygon
+    """
+    polygon = hull_polygon(convex_hull)
+    xs = [point[0] for point in polygon]
+    ys = [point[1] for point in polygon]
+    min_x, min_y = lonlat_to_tile(min(xs), max(ys), zoom)
+    max_x, max_y = lonlat_to_tile(max(xs), min(ys), zoom)
+
+    tiles = []
+
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            if polygon_intersects_box(polygon, *tile_bounds(x, y, zoom)):
+                tiles.append((x, y))
+
+    return tiles
 
 def is_granule_selected(view_list, date, time):
     """
@@ -114,7 +176,7 @@ def rgb_url(api_url, *keys, red_key, green_key, blue_key, stretch_range):
     
     return f"{url}?{urllib.parse.urlencode(params)}"
 
-def combine_url(api_url, keys_list, rgb_keys = None):
+def combine_url(api_url, keys_list, rgb_keys = None, channel = None, colormap = None, stretch_range = None):
     """
     Returns a terracota combine end point url
     given the keys and optional rgb channel
@@ -127,4 +189,61 @@ def combine_url(api_url, keys_list, rgb_keys = None):
         "rgb_keys": json.dumps(rgb_keys)
     }
 
-    return f"{url}?{urllib.parse.urlencode(params)}"
\ No newline at end of file
+    if channel != None:
+        params["channel"] = channel
+    if colormap != None:
+        params["colormap"] = colormap
+    if stretch_range != None:
+        params["stretch_range"] = json.dumps(list(stretch_range))
+
+    return f"{url}?{urllib.parse.urlencode(params)}"
+
+def histogram_percentiles(histograms, percentiles):
+    """
+    Percentiles of the data behind several compact histograms,
+    each {"range": [low, high], "counts": [...]}, found by
+    merging their cumulative counts, taken as linear within
+    each bin, over the edges of all of them
+    """
+    edges = np.unique(np.concatenate([np.linspace(*histogram["range"], len(histogram["counts"]) + 1)
+                                      for histogram in histograms]))
+    # counts below (left) and up to (right) each edge, which only
+    # differ at a histogram holding a single value
+    below, up_to = np.zeros(len(edges)), np.zeros(len(edges))
+
+    for histogram in histograms:
+        low, high = histogram["range"]
+        counts = np.asarray(histogram["counts"], dtype="float64")
+
+        if high > low:
+            cumulative = np.interp(edges, np.linspace(low, high, len(counts) + 1),
+                                   np.concatenate([[0], np.cumsum(counts)]))
+            below += cumulative
+            up_to += cumulative
+        else:
+            below += np.where(edges > low, counts.sum(), 0)
+            up_to += np.where(edges >= low, counts.sum(), 0)
+
+    cumulative = np.column_stack([below, up_to]).ravel()
+
+    if cumulative[-1] <= 0:
+        return [float(edges[0]) for _ in percentiles]
+
+    targets = np.asarray(percentiles) / 100 * cumulative[-1]
+    return [float(value) for value in np.interp(targets, cumulative, np.repeat(edges, 2))]
+
+def percentile_stretch(metadatas, percentiles=(2, 98)):
+    """
+    Shared (low, high) stretch of several terracotta datasets
+    from the histograms stored with them at ingestion. Datasets
+    inserted before histograms existed fall back to terracotta's
+    own 1-99 percentiles, widened across the datasets
+    """
+    histograms = [metadata.get("metadata", {}).get("histogram") for metadata in metadatas]
+
+    if len(histograms) > 0 and all(histogram != None for histogram in histograms):
+        return histogram_percentiles(histograms, percentiles)
+
+    low, high = percentiles
+    return [min(float(metadata["percentiles"][low - 1]) for metadata in metadatas),
+            max(float(metadata["percentiles"][high - 1]) for metadata in metadatas)]